@@ -0,0 +1,282 @@
+"""Offline benchmark of the bot.
+
+Starts a fake Moodle web service and a fake Bot API server on localhost,
+points the bot at them and replays synthetic updates through the
+dispatcher. Each scenario prints its throughput and p50/p99 latency.
+
+    python benchmark.py --users 500 --moodle-latency 50
+    python benchmark.py --scenarios deadlines_cold deadlines_warm
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from aiohttp import web
+
+
+SCENARIOS = ['registration', 'deadlines_cold', 'deadlines_warm', 'broadcast_private', 'broadcast_group']
+ADMIN_ID = 1
+
+
+# Stand-in for the Moodle REST endpoint. User N logs in with token-N and
+# is enrolled in `courses` courses picked from a shared pool, so cohort
+# members overlap the way real students do.
+class FakeMoodle:
+    def __init__(self, courses=6, assignments=8, course_pool=40, latency=0.0):
+        self.courses = courses
+        self.assignments = assignments
+        self.course_pool = course_pool
+        self.latency = latency
+        self.base = int(time.time())
+        self.calls = {}
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route('*', '/', self.handle)
+        return app
+
+    async def handle(self, request):
+        params = request.query
+        wsfunction = params.get('wsfunction')
+        self.calls[wsfunction] = self.calls.get(wsfunction, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        token = params.get('wstoken', '')
+        if not token.startswith('token-'):
+            return web.json_response({'exception': 'moodle_exception', 'errorcode': 'invalidtoken',
+                                      'message': 'Invalid token - token not found'})
+        user_id = int(token[len('token-'):])
+
+        if wsfunction == 'core_webservice_get_site_info':
+            return web.json_response({'userid': user_id, 'timezone': 'Asia/Almaty'})
+        if wsfunction == 'core_enrol_get_users_courses':
+            return web.json_response([
+                {'id': course_id, 'fullname': f"Course {course_id}"} for course_id in self.user_courses(user_id)
+            ])
+        if wsfunction == 'mod_assign_get_assignments':
+            course_ids = [int(value) for key, value in params.items() if key.startswith('courseids[')]
+            return web.json_response({'courses': [self.course(course_id) for course_id in course_ids], 'warnings': []})
+        return web.json_response({'exception': 'moodle_exception', 'errorcode': 'invalidrecord',
+                                  'message': f"Unknown function {wsfunction}"})
+
+    def user_courses(self, user_id):
+        return [(user_id + offset * 7) % self.course_pool + 1 for offset in range(self.courses)]
+
+    def course(self, course_id):
+        assignments = []
+        for index in range(self.assignments):
+            name = "Midterm" if index == 0 else f"Assignment {index}"
+            assignments.append({
+                'id': course_id * 1000 + index,
+                'name': name,
+                'duedate': self.base + 3600 * (course_id + 13 * index) - 86400,
+                'timemodified': self.base,
+                'intro': "<p>" + "Lorem ipsum dolor sit amet. " * 20 + "</p>",
+                'introattachments': [],
+                'configs': [{'plugin': 'file', 'subtype': 'assignsubmission', 'name': 'enabled', 'value': '1'}] * 5,
+            })
+        return {'id': course_id, 'fullname': f"Course {course_id}", 'assignments': assignments}
+
+
+# Stand-in for the Telegram Bot API. Every method succeeds; send and edit
+# methods answer with a message, everything else with True.
+class FakeTelegram:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self.sent_at = {}
+        self._message_ids = itertools.count(1000)
+
+    def app(self):
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        data = await request.post()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == 'getMe':
+            return self.ok({'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'})
+        if method.startswith('send') or method.startswith('edit'):
+            chat_id = int(data.get('chat_id', 0))
+            self.sent_at.setdefault(chat_id, time.perf_counter())
+            return self.ok({
+                'message_id': int(data.get('message_id') or next(self._message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+                'text': data.get('text', ''),
+            })
+        return self.ok(True)
+
+    @staticmethod
+    def ok(result):
+        return web.json_response({'ok': True, 'result': result})
+
+
+class LoadGenerator:
+    def __init__(self, dp, bot, concurrency=50):
+        self.dp = dp
+        self.bot = bot
+        self.concurrency = concurrency
+        self._update_ids = itertools.count(1)
+
+    def message(self, chat_id, text, user_id=None, chat_type='private'):
+        user_id = user_id or chat_id
+        update_id = next(self._update_ids)
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': chat_type, 'first_name': f"User {user_id}", 'title': f"Group {chat_id}"},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"},
+                'text': text,
+            },
+        }
+
+    # Runs `session(key)` for every key, `concurrency` at a time, and
+    # returns the latency of each session in seconds and the total time.
+    async def run(self, keys, session):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        latencies = []
+
+        async def one(key):
+            async with semaphore:
+                started = time.perf_counter()
+                await session(key)
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(key) for key in keys))
+        return latencies, time.perf_counter() - started
+
+    async def feed(self, *updates):
+        for update in updates:
+            await self.dp.feed_raw_update(self.bot, update)
+
+
+def report(name, latencies, elapsed, unit='ops'):
+    if not latencies:
+        print(f"{name:<20} no operations")
+        return
+    ordered = sorted(latencies)
+    p50 = statistics.median(ordered)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(f"{name:<20} {len(ordered):>6} {unit:<5} {elapsed:>8.2f}s {len(ordered) / elapsed:>9.1f}/s "
+          f"p50 {p50 * 1000:>8.1f}ms  p99 {p99 * 1000:>8.1f}ms")
+
+
+async def serve(app):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+async def run_benchmark(args):
+    fake_moodle = FakeMoodle(args.courses, args.assignments, args.course_pool, args.moodle_latency / 1000)
+    fake_telegram = FakeTelegram(args.telegram_latency / 1000)
+    moodle_runner, moodle_port = await serve(fake_moodle.app())
+    telegram_runner, telegram_port = await serve(fake_telegram.app())
+    db_dir = tempfile.TemporaryDirectory()
+
+    # main reads its configuration at import time
+    os.environ.update({
+        'TEL_API_TOKEN': '123456:benchmark',
+        'REQUEST_URL': f"http://127.0.0.1:{moodle_port}/",
+        'TELEGRAM_API_URL': f"http://127.0.0.1:{telegram_port}",
+        'ADMIN_ID': str(ADMIN_ID),
+        'DB_PATH': os.path.join(db_dir.name, 'bench.db'),
+        'METRICS_PORT': '0',
+        'REMINDER_OFFSETS': '',
+        'BROADCAST_RATE': str(args.broadcast_rate),
+    })
+    bot_main = importlib.import_module('main')
+    # Per-update INFO logs would dominate the measurement
+    logging.getLogger().setLevel(logging.WARNING)
+    await bot_main.startup()
+
+    load = LoadGenerator(bot_main.dp, bot_main.bot, args.concurrency)
+    users = list(range(1000, 1000 + args.users))
+    groups = [-1000000 - index for index in range(args.groups)]
+
+    async def register(chat_id):
+        await load.feed(load.message(chat_id, '/start'), load.message(chat_id, f"token-{chat_id}"))
+
+    async def deadlines(chat_id):
+        await load.feed(load.message(chat_id, 'Deadlines'))
+
+    async def broadcast(kind, menu_button, targets):
+        fake_telegram.sent_at.clear()
+        started = time.perf_counter()
+        await load.feed(load.message(ADMIN_ID, menu_button), load.message(ADMIN_ID, f"Benchmark {kind} broadcast"))
+        await bot_main.broadcaster.wait()
+        elapsed = time.perf_counter() - started
+        latencies = [fake_telegram.sent_at[chat_id] - started for chat_id in targets if chat_id in fake_telegram.sent_at]
+        report(f"broadcast_{kind}", latencies, elapsed, unit='msgs')
+
+    print(f"{args.users} users, {args.courses} courses x {args.assignments} assignments, "
+          f"Moodle {args.moodle_latency}ms, Telegram {args.telegram_latency}ms, concurrency {args.concurrency}")
+    try:
+        for scenario in args.scenarios:
+            moodle_calls = sum(fake_moodle.calls.values())
+            if scenario == 'registration':
+                report(scenario, *await load.run(users, register), unit='users')
+            elif scenario in ('deadlines_cold', 'deadlines_warm'):
+                if scenario == 'deadlines_cold':
+                    for user_id in users:
+                        token = await bot_main.db.get_token(user_id)
+                        if token:
+                            bot_main.deadline_cache.invalidate(token)
+                report(scenario, *await load.run(users, deadlines), unit='reqs')
+            elif scenario == 'broadcast_private':
+                await broadcast('private', "Induvidual chats", users)
+            elif scenario == 'broadcast_group':
+                # Groups register themselves when the bot sees a message there
+                await load.run(groups, lambda chat_id: load.feed(
+                    load.message(chat_id, "hello", random.choice(users), chat_type='supergroup')))
+                await broadcast('group', "Group chats", groups)
+            print(f"{'':<20} Moodle requests: {sum(fake_moodle.calls.values()) - moodle_calls}")
+    finally:
+        await bot_main.shutdown()
+        await bot_main.bot.session.close()
+        await moodle_runner.cleanup()
+        await telegram_runner.cleanup()
+        db_dir.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--courses', type=int, default=6, help="courses per user")
+    parser.add_argument('--course-pool', type=int, default=40, help="distinct courses shared by all users")
+    parser.add_argument('--assignments', type=int, default=8, help="assignments per course")
+    parser.add_argument('--moodle-latency', type=float, default=20, help="ms added to every Moodle request")
+    parser.add_argument('--telegram-latency', type=float, default=5, help="ms added to every Bot API request")
+    parser.add_argument('--concurrency', type=int, default=50, help="updates processed at once")
+    parser.add_argument('--broadcast-rate', type=float, default=1000, help="broadcast messages per second")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    args = parser.parse_args()
+
+    # Registration has to come first, every other scenario needs users
+    if 'registration' not in args.scenarios:
+        args.scenarios.insert(0, 'registration')
+    asyncio.run(run_benchmark(args))
+
+
+if __name__ == '__main__':
+    main()
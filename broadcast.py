@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+
+# Token bucket shared by every sender of a broadcast.
+# pause() stops everyone until Telegram's RetryAfter has passed.
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+# Spaces out messages to the same chat (Telegram allows ~1/s per private
+# chat and ~20/min per group). Only chats sent to recently are remembered.
+class ChatLimiter:
+    def __init__(self, interval):
+        self.interval = interval
+        self._next_allowed = {}
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        if len(self._next_allowed) > 10000:
+            self._next_allowed = {key: value for key, value in self._next_allowed.items() if value > now}
+
+        next_allowed = self._next_allowed.get(chat_id, now)
+        self._next_allowed[chat_id] = max(now, next_allowed) + self.interval
+        if next_allowed > now:
+            await asyncio.sleep(next_allowed - now)
+
+
+# Broadcast jobs persisted in broadcast_jobs/broadcast_targets.
+# Every target row is marked once its message is delivered, so a job
+# interrupted by a restart is resumed with only the pending chats.
+class Broadcaster:
+    CHAT_INTERVALS = {'private': 1.0, 'group': 3.0}
+
+    def __init__(self, bot, db, rate=25, senders=10, max_retries=3, report_interval=5, on_blocked=None,
+                 on_delivery=None):
+        self.bot = bot
+        self.db = db
+        self.senders = senders
+        self.max_retries = max_retries
+        self.report_interval = report_interval
+        self.on_blocked = on_blocked
+        # on_delivery(kind, status) after every target is processed
+        self.on_delivery = on_delivery
+        self.limiter = TokenBucket(rate)
+        self.chat_limiters = {kind: ChatLimiter(interval) for kind, interval in self.CHAT_INTERVALS.items()}
+        self._jobs = {}
+
+    async def start(self, kind, text, admin_chat_id):
+        job = await self.db.create_broadcast_job(kind, text, admin_chat_id)
+        self._spawn(job)
+        return job['id']
+
+    # owns_chat limits resuming to jobs whose admin chat this process serves
+    async def resume(self, owns_chat=None):
+        for job in await self.db.get_running_broadcast_jobs():
+            if owns_chat is not None and not owns_chat(job['admin_chat_id']):
+                continue
+            logging.info(f"Resuming broadcast #{job['id']}")
+            self._spawn(job)
+
+    # Resolves once every running job has finished
+    async def wait(self):
+        while self._jobs:
+            await asyncio.gather(*list(self._jobs.values()), return_exceptions=True)
+
+    async def stop(self):
+        for task in self._jobs.values():
+            task.cancel()
+        await asyncio.gather(*self._jobs.values(), return_exceptions=True)
+        self._jobs = {}
+
+    def _spawn(self, job):
+        task = asyncio.create_task(self._run(job))
+        self._jobs[job['id']] = task
+        task.add_done_callback(lambda _: self._jobs.pop(job['id'], None))
+
+    async def _run(self, job):
+        job_id = job['id']
+        pending = await self.db.get_pending_broadcast_targets(job_id)
+        counts = await self.db.get_broadcast_counts(job_id)
+        stats = {
+            'total': sum(counts.values()),
+            'sent': counts.get('sent', 0),
+            'failed': counts.get('failed', 0),
+            'blocked': counts.get('blocked', 0),
+            'started': time.monotonic(),
+            'sent_now': 0,
+        }
+
+        queue = asyncio.Queue()
+        for chat_id in pending:
+            queue.put_nowait(chat_id)
+
+        report = await self.bot.send_message(job['admin_chat_id'], self._format_report(job_id, stats))
+        reporter = asyncio.create_task(self._report_loop(job, report.message_id, stats))
+        senders = [asyncio.create_task(self._sender(job, queue, stats))
+                   for _ in range(min(self.senders, len(pending)))]
+        try:
+            await asyncio.gather(*senders)
+        finally:
+            reporter.cancel()
+            for sender in senders:
+                sender.cancel()
+
+        await self.db.set_broadcast_job_status(job_id, 'done')
+        await self._edit_report(job, report.message_id, self._format_report(job_id, stats, done=True))
+
+    async def _sender(self, job, queue, stats):
+        while not queue.empty():
+            chat_id = queue.get_nowait()
+            status = await self._deliver(job, chat_id)
+            stats[status] += 1
+            if status == 'sent':
+                stats['sent_now'] += 1
+            if self.on_delivery:
+                self.on_delivery(job['kind'], status)
+            await self.db.set_broadcast_target_status(job['id'], chat_id, status)
+
+    async def _deliver(self, job, chat_id):
+        for _ in range(self.max_retries + 1):
+            await self.chat_limiters[job['kind']].acquire(chat_id)
+            await self.limiter.acquire()
+            try:
+                await self.bot.send_message(chat_id, job['text'])
+                return 'sent'
+            except TelegramRetryAfter as e:
+                logging.warning(f"Broadcast #{job['id']} rate limited, retrying in {e.retry_after}s")
+                self.limiter.pause(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                if isinstance(e, TelegramBadRequest) and 'chat not found' not in e.message.lower():
+                    logging.error(f"Failed to send message to {chat_id}: {e}")
+                    return 'failed'
+                await self._prune(job['kind'], chat_id)
+                return 'blocked'
+            except Exception as e:
+                logging.error(f"Failed to send message to {chat_id}: {e}")
+                return 'failed'
+        return 'failed'
+
+    async def _prune(self, kind, chat_id):
+        if kind == 'private':
+            await self.db.delete_token(chat_id)
+        else:
+            await self.db.delete_group_chat_id(chat_id)
+        if self.on_blocked:
+            self.on_blocked(kind, chat_id)
+
+    async def _report_loop(self, job, message_id, stats):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            await self._edit_report(job, message_id, self._format_report(job['id'], stats))
+
+    async def _edit_report(self, job, message_id, text):
+        try:
+            await self.bot.edit_message_text(text=text, chat_id=job['admin_chat_id'], message_id=message_id)
+        except TelegramBadRequest:
+            # "message is not modified" when nothing changed since the last report
+            pass
+
+    @staticmethod
+    def _format_report(job_id, stats, done=False):
+        processed = stats['sent'] + stats['failed'] + stats['blocked']
+        elapsed = max(time.monotonic() - stats['started'], 0.001)
+        title = "finished" if done else "in progress"
+        return (
+            f"📣 Broadcast #{job_id} {title}\n"
+            f"Processed: {processed}/{stats['total']}\n"
+            f"✅ Sent: {stats['sent']}\n"
+            f"❌ Failed: {stats['failed']}\n"
+            f"🚫 Blocked (removed): {stats['blocked']}\n"
+            f"⚡ {stats['sent_now'] / elapsed:.1f} msg/s"
+        )
@@ -0,0 +1,527 @@
+import aiosqlite
+import asyncio
+import csv
+import gzip
+import json
+import logging
+import sqlite3
+import time
+from collections import namedtuple
+
+
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000',
+)
+
+# Statements are module constants so sqlite3's statement cache reuses
+# the prepared statement on every call.
+CREATE_USER_TOKENS = '''
+    CREATE TABLE IF NOT EXISTS user_tokens (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL UNIQUE,
+        first_name TEXT NOT NULL,
+        token TEXT NOT NULL
+    )
+'''
+CREATE_GROUP_CHAT = '''
+    CREATE TABLE IF NOT EXISTS group_chat (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL UNIQUE
+    )
+'''
+# Columns added after the first release, applied to existing databases on open
+USER_TOKENS_MIGRATIONS = {
+    'moodle_user_id': 'ALTER TABLE user_tokens ADD COLUMN moodle_user_id INTEGER',
+    'timezone': 'ALTER TABLE user_tokens ADD COLUMN timezone TEXT',
+    'synced_at': 'ALTER TABLE user_tokens ADD COLUMN synced_at INTEGER',
+}
+INSERT_TOKEN = '''
+    INSERT OR REPLACE INTO user_tokens (chat_id, first_name, token, moodle_user_id, timezone)
+    VALUES (?, ?, ?, ?, ?)
+'''
+SELECT_TOKEN = 'SELECT token FROM user_tokens WHERE chat_id = ?'
+SELECT_USER = 'SELECT chat_id, first_name, token, moodle_user_id, timezone, synced_at FROM user_tokens WHERE chat_id = ?'
+UPDATE_SITE_INFO = 'UPDATE user_tokens SET moodle_user_id = ?, timezone = ? WHERE chat_id = ?'
+SELECT_REGISTERED = 'SELECT 1 FROM user_tokens WHERE chat_id = ?'
+SELECT_USER_IDS = 'SELECT chat_id FROM user_tokens'
+DELETE_TOKEN = 'DELETE FROM user_tokens WHERE chat_id = ?'
+GROUP_CHAT_MIGRATIONS = {
+    'digest_user_id': 'ALTER TABLE group_chat ADD COLUMN digest_user_id INTEGER',
+    'digest_interval': 'ALTER TABLE group_chat ADD COLUMN digest_interval INTEGER',
+    'digest_message_id': 'ALTER TABLE group_chat ADD COLUMN digest_message_id INTEGER',
+    'digest_updated_at': 'ALTER TABLE group_chat ADD COLUMN digest_updated_at INTEGER',
+}
+INSERT_GROUP_CHAT = 'INSERT OR IGNORE INTO group_chat (chat_id) VALUES (?)'
+SELECT_GROUP_CHAT_IDS = 'SELECT chat_id FROM group_chat'
+DELETE_GROUP_CHAT = 'DELETE FROM group_chat WHERE chat_id = ?'
+SELECT_GROUP_DIGEST = '''
+    SELECT chat_id, digest_user_id, digest_interval, digest_message_id, digest_updated_at
+    FROM group_chat WHERE chat_id = ? AND digest_user_id IS NOT NULL
+'''
+SELECT_DUE_DIGESTS = '''
+    SELECT chat_id, digest_user_id, digest_interval, digest_message_id, digest_updated_at
+    FROM group_chat
+    WHERE digest_user_id IS NOT NULL AND COALESCE(digest_updated_at, 0) + digest_interval <= ?
+'''
+ENABLE_DIGEST = '''
+    INSERT INTO group_chat (chat_id, digest_user_id, digest_interval) VALUES (?, ?, ?)
+    ON CONFLICT (chat_id) DO UPDATE SET
+        digest_user_id = excluded.digest_user_id,
+        digest_interval = excluded.digest_interval,
+        digest_updated_at = NULL
+'''
+DISABLE_DIGEST = '''
+    UPDATE group_chat SET digest_user_id = NULL, digest_interval = NULL,
+        digest_message_id = NULL, digest_updated_at = NULL
+    WHERE chat_id = ?
+'''
+DISABLE_USER_DIGESTS = '''
+    UPDATE group_chat SET digest_user_id = NULL, digest_interval = NULL,
+        digest_message_id = NULL, digest_updated_at = NULL
+    WHERE digest_user_id = ?
+'''
+UPDATE_DIGEST = 'UPDATE group_chat SET digest_message_id = ?, digest_updated_at = ? WHERE chat_id = ?'
+
+CREATE_BROADCAST_JOBS = '''
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        text TEXT NOT NULL,
+        admin_chat_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        created_at INTEGER NOT NULL
+    )
+'''
+CREATE_BROADCAST_TARGETS = '''
+    CREATE TABLE IF NOT EXISTS broadcast_targets (
+        job_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        PRIMARY KEY (job_id, chat_id)
+    ) WITHOUT ROWID
+'''
+INSERT_BROADCAST_JOB = 'INSERT INTO broadcast_jobs (kind, text, admin_chat_id, created_at) VALUES (?, ?, ?, ?)'
+# Targets are copied from the recipient table when the job is created,
+# so users who register mid-broadcast are not picked up on resume.
+INSERT_BROADCAST_TARGETS = {
+    'private': 'INSERT INTO broadcast_targets (job_id, chat_id) SELECT ?, chat_id FROM user_tokens',
+    'group': 'INSERT INTO broadcast_targets (job_id, chat_id) SELECT ?, chat_id FROM group_chat',
+}
+SELECT_RUNNING_BROADCASTS = "SELECT id, kind, text, admin_chat_id FROM broadcast_jobs WHERE status = 'running'"
+SELECT_BROADCAST_JOB = 'SELECT id, kind, text, admin_chat_id FROM broadcast_jobs WHERE id = ?'
+SELECT_BROADCAST_COUNTS = 'SELECT status, COUNT(*) FROM broadcast_targets WHERE job_id = ? GROUP BY status'
+SELECT_PENDING_TARGETS = "SELECT chat_id FROM broadcast_targets WHERE job_id = ? AND status = 'pending'"
+UPDATE_BROADCAST_TARGET = 'UPDATE broadcast_targets SET status = ? WHERE job_id = ? AND chat_id = ?'
+UPDATE_BROADCAST_JOB = 'UPDATE broadcast_jobs SET status = ? WHERE id = ?'
+
+CREATE_COURSES = '''
+    CREATE TABLE IF NOT EXISTS courses (
+        id INTEGER PRIMARY KEY,
+        fullname TEXT NOT NULL
+    )
+'''
+CREATE_ASSIGNMENTS = '''
+    CREATE TABLE IF NOT EXISTS assignments (
+        chat_id INTEGER NOT NULL,
+        assignment_id INTEGER NOT NULL,
+        course_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        duedate INTEGER NOT NULL,
+        timemodified INTEGER NOT NULL,
+        PRIMARY KEY (chat_id, assignment_id)
+    ) WITHOUT ROWID
+'''
+CREATE_ASSIGNMENTS_DUE_INDEX = 'CREATE INDEX IF NOT EXISTS assignments_due ON assignments (chat_id, duedate)'
+UPSERT_COURSE = '''
+    INSERT INTO courses (id, fullname) VALUES (?, ?)
+    ON CONFLICT (id) DO UPDATE SET fullname = excluded.fullname WHERE fullname != excluded.fullname
+'''
+UPSERT_ASSIGNMENT = '''
+    INSERT INTO assignments (chat_id, assignment_id, course_id, name, duedate, timemodified)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (chat_id, assignment_id) DO UPDATE SET
+        course_id = excluded.course_id,
+        name = excluded.name,
+        duedate = excluded.duedate,
+        timemodified = excluded.timemodified
+'''
+SELECT_ASSIGNMENT_VERSIONS = '''
+    SELECT assignment_id, course_id, duedate, timemodified FROM assignments WHERE chat_id = ?
+'''
+DELETE_ASSIGNMENT = 'DELETE FROM assignments WHERE chat_id = ? AND assignment_id = ?'
+DELETE_USER_ASSIGNMENTS = 'DELETE FROM assignments WHERE chat_id = ?'
+SELECT_UPCOMING_ASSIGNMENTS = '''
+    SELECT a.assignment_id AS id, c.fullname AS course, a.name, a.duedate
+    FROM assignments a JOIN courses c ON c.id = a.course_id
+    WHERE a.chat_id = ? AND a.duedate >= ?
+    ORDER BY a.duedate
+'''
+UPDATE_SYNCED_AT = 'UPDATE user_tokens SET synced_at = ? WHERE chat_id = ?'
+
+CREATE_FSM_STORAGE = '''
+    CREATE TABLE IF NOT EXISTS fsm_storage (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    ) WITHOUT ROWID
+'''
+CREATE_MANUAL_COURSES = '''
+    CREATE TABLE IF NOT EXISTS manual_courses (
+        id INTEGER PRIMARY KEY,
+        chat_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        credits REAL NOT NULL,
+        percentage REAL NOT NULL
+    )
+'''
+CREATE_MANUAL_COURSES_INDEX = 'CREATE INDEX IF NOT EXISTS manual_courses_chat ON manual_courses (chat_id)'
+INSERT_MANUAL_COURSE = 'INSERT INTO manual_courses (chat_id, name, credits, percentage) VALUES (?, ?, ?, ?)'
+SELECT_MANUAL_COURSES = 'SELECT name, credits, percentage FROM manual_courses WHERE chat_id = ? ORDER BY id'
+DELETE_MANUAL_COURSES = 'DELETE FROM manual_courses WHERE chat_id = ?'
+SELECT_FSM_RECORD = 'SELECT state, data, updated_at FROM fsm_storage WHERE key = ?'
+UPSERT_FSM_RECORD = '''
+    INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+    ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+'''
+DELETE_FSM_RECORD = 'DELETE FROM fsm_storage WHERE key = ?'
+DELETE_EXPIRED_FSM_RECORDS = 'DELETE FROM fsm_storage WHERE updated_at < ?'
+COUNT_CHATS = 'SELECT (SELECT COUNT(*) FROM user_tokens), (SELECT COUNT(*) FROM group_chat)'
+COUNT_FSM_STATES = 'SELECT state, COUNT(*) FROM fsm_storage WHERE updated_at >= ? GROUP BY state'
+
+# Exports leave tokens out on purpose
+EXPORT_COLUMNS = ('type', 'chat_id', 'first_name', 'moodle_user_id', 'timezone', 'synced_at',
+                  'digest_user_id', 'digest_interval', 'digest_updated_at')
+EXPORT_CHATS = '''
+    SELECT 'user', chat_id, first_name, moodle_user_id, timezone, synced_at, NULL, NULL, NULL
+    FROM user_tokens
+    UNION ALL
+    SELECT 'group', chat_id, NULL, NULL, NULL, NULL, digest_user_id, digest_interval, digest_updated_at
+    FROM group_chat
+'''
+
+WriteResult = namedtuple('WriteResult', 'rowcount lastrowid')
+
+
+# Online backup into `target_path` through a connection of its own.
+# The default copies everything in one step: a stepwise backup restarts
+# whenever the bot writes in between steps, which it does every fraction
+# of a second, while in WAL mode a single step does not block its writes.
+def _backup(path, target_path, pages):
+    source = sqlite3.connect(path)
+    try:
+        target = sqlite3.connect(target_path)
+        try:
+            source.backup(target, pages=pages)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+# Streams user and group rows into a gzip file, `chunk_size` rows at a time
+def _export_chats(path, target_path, fmt, chunk_size):
+    source = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        # One read transaction, so the rows come from a single snapshot
+        source.execute('BEGIN')
+        cursor = source.execute(EXPORT_CHATS)
+        with gzip.open(target_path, 'wt', encoding='utf-8', newline='') as file:
+            if fmt == 'csv':
+                writer = csv.writer(file)
+                writer.writerow(EXPORT_COLUMNS)
+                while rows := cursor.fetchmany(chunk_size):
+                    writer.writerows(rows)
+            else:
+                file.write('[')
+                separator = '\n'
+                while rows := cursor.fetchmany(chunk_size):
+                    for row in rows:
+                        file.write(separator + json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False))
+                        separator = ',\n'
+                file.write('\n]\n')
+        source.rollback()
+    finally:
+        source.close()
+
+
+# Repository over users.db.
+# One connection is opened for the lifetime of the bot. Reads go straight
+# to it; writes are queued and a single writer task commits everything
+# queued at the same moment in one transaction.
+class Database:
+    def __init__(self, path, batch_size=100, on_query=None):
+        self.path = path
+        self.batch_size = batch_size
+        # on_query(kind, seconds) after every read ('read') and committed batch ('write')
+        self.on_query = on_query
+        self._conn = None
+        self._writes = None
+        self._writer = None
+
+    async def open(self):
+        self._conn = await aiosqlite.connect(self.path, isolation_level=None, cached_statements=256)
+        self._conn.row_factory = aiosqlite.Row
+        for pragma in PRAGMAS:
+            await self._conn.execute(pragma)
+
+        # Worker processes open the same file at once; the write lock taken
+        # up front makes them create and migrate the schema one at a time,
+        # each seeing the columns added by the ones before it.
+        await self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            await self._conn.execute(CREATE_USER_TOKENS)
+            await self._conn.execute(CREATE_GROUP_CHAT)
+            await self._conn.execute(CREATE_BROADCAST_JOBS)
+            await self._conn.execute(CREATE_BROADCAST_TARGETS)
+            await self._conn.execute(CREATE_COURSES)
+            await self._conn.execute(CREATE_ASSIGNMENTS)
+            await self._conn.execute(CREATE_ASSIGNMENTS_DUE_INDEX)
+            await self._conn.execute(CREATE_FSM_STORAGE)
+            await self._conn.execute(CREATE_MANUAL_COURSES)
+            await self._conn.execute(CREATE_MANUAL_COURSES_INDEX)
+            await self._migrate('user_tokens', USER_TOKENS_MIGRATIONS)
+            await self._migrate('group_chat', GROUP_CHAT_MIGRATIONS)
+        except BaseException:
+            await self._conn.execute('ROLLBACK')
+            raise
+        await self._conn.execute('COMMIT')
+
+        self._writes = asyncio.Queue()
+        self._writer = asyncio.create_task(self._write_loop())
+
+    async def close(self):
+        if self._writer is not None:
+            await self._writes.join()
+            self._writer.cancel()
+            self._writer = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def _migrate(self, table, migrations):
+        columns = {row['name'] for row in await self.fetchall(f'PRAGMA table_info({table})')}
+        for column, sql in migrations.items():
+            if column not in columns:
+                await self._conn.execute(sql)
+
+    async def _write_loop(self):
+        while True:
+            batch = [await self._writes.get()]
+            # Let other coroutines that are about to write join this batch
+            await asyncio.sleep(0)
+            while len(batch) < self.batch_size and not self._writes.empty():
+                batch.append(self._writes.get_nowait())
+
+            started = time.perf_counter()
+            try:
+                await self._commit_batch(batch)
+                if self.on_query:
+                    self.on_query('write', time.perf_counter() - started)
+            except Exception as e:
+                logging.error(f"Database write batch failed: {e}")
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                for _ in batch:
+                    self._writes.task_done()
+
+    async def _commit_batch(self, batch):
+        results = []
+        await self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Each write gets its own savepoint, so one bad statement
+            # does not roll back the other callers' writes.
+            for sql, params, _, many in batch:
+                await self._conn.execute('SAVEPOINT write')
+                try:
+                    if many:
+                        cursor = await self._conn.executemany(sql, params)
+                    else:
+                        cursor = await self._conn.execute(sql, params)
+                    results.append(WriteResult(cursor.rowcount, cursor.lastrowid))
+                except aiosqlite.Error as e:
+                    await self._conn.execute('ROLLBACK TO write')
+                    results.append(e)
+                await self._conn.execute('RELEASE write')
+            await self._conn.execute('COMMIT')
+        except BaseException:
+            await self._conn.execute('ROLLBACK')
+            raise
+
+        for (_, _, future, _), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def write(self, sql, params=(), many=False):
+        future = asyncio.get_running_loop().create_future()
+        await self._writes.put((sql, params, future, many))
+        return await future
+
+    async def fetchone(self, sql, params=()):
+        started = time.perf_counter()
+        async with self._conn.execute(sql, params) as cursor:
+            row = await cursor.fetchone()
+        if self.on_query:
+            self.on_query('read', time.perf_counter() - started)
+        return row
+
+    async def fetchall(self, sql, params=()):
+        started = time.perf_counter()
+        async with self._conn.execute(sql, params) as cursor:
+            rows = await cursor.fetchall()
+        if self.on_query:
+            self.on_query('read', time.perf_counter() - started)
+        return rows
+
+    # Consistent copy of the whole database, taken off the event loop
+    async def backup(self, target_path, pages=-1):
+        await asyncio.to_thread(_backup, self.path, target_path, pages)
+
+    # Gzipped CSV or JSON export of user and group rows, without tokens
+    async def export_chats(self, target_path, fmt='csv', chunk_size=500):
+        await asyncio.to_thread(_export_chats, self.path, target_path, fmt, chunk_size)
+
+    async def store_token(self, chat_id, first_name, token, moodle_user_id=None, timezone=None):
+        await self.write(INSERT_TOKEN, (chat_id, first_name, token, moodle_user_id, timezone))
+
+    async def get_token(self, chat_id):
+        result = await self.fetchone(SELECT_TOKEN, (chat_id,))
+        return result[0] if result else None
+
+    async def get_user(self, chat_id):
+        return await self.fetchone(SELECT_USER, (chat_id,))
+
+    async def update_site_info(self, chat_id, moodle_user_id, timezone):
+        await self.write(UPDATE_SITE_INFO, (moodle_user_id, timezone, chat_id))
+
+    async def is_user_registered(self, chat_id):
+        return await self.fetchone(SELECT_REGISTERED, (chat_id,)) is not None
+
+    async def get_users_id(self):
+        return [row[0] for row in await self.fetchall(SELECT_USER_IDS)]
+
+    # Also turns off the group digests linked to the user's deadlines
+    async def delete_token(self, chat_id):
+        try:
+            await self.write(DELETE_TOKEN, (chat_id,))
+            await self.write(DELETE_USER_ASSIGNMENTS, (chat_id,))
+            await self.write(DISABLE_USER_DIGESTS, (chat_id,))
+        except aiosqlite.Error as e:
+            logging.error(f"Error deleting token for {chat_id}: {e}")
+
+    async def store_group_chat_id(self, chat_id):
+        await self.write(INSERT_GROUP_CHAT, (chat_id,))
+
+    async def get_all_group_chat_ids(self):
+        return [row[0] for row in await self.fetchall(SELECT_GROUP_CHAT_IDS)]
+
+    async def delete_group_chat_id(self, chat_id):
+        await self.write(DELETE_GROUP_CHAT, (chat_id,))
+
+    async def get_group_digest(self, chat_id):
+        return await self.fetchone(SELECT_GROUP_DIGEST, (chat_id,))
+
+    async def get_due_digests(self, current_timestamp):
+        return await self.fetchall(SELECT_DUE_DIGESTS, (current_timestamp,))
+
+    async def enable_digest(self, chat_id, user_chat_id, interval):
+        await self.write(ENABLE_DIGEST, (chat_id, user_chat_id, interval))
+
+    async def disable_digest(self, chat_id):
+        await self.write(DISABLE_DIGEST, (chat_id,))
+
+    async def update_digest(self, chat_id, message_id, updated_at):
+        await self.write(UPDATE_DIGEST, (message_id, updated_at, chat_id))
+
+    async def create_broadcast_job(self, kind, text, admin_chat_id):
+        result = await self.write(INSERT_BROADCAST_JOB, (kind, text, admin_chat_id, int(time.time())))
+        await self.write(INSERT_BROADCAST_TARGETS[kind], (result.lastrowid,))
+        return await self.fetchone(SELECT_BROADCAST_JOB, (result.lastrowid,))
+
+    async def get_running_broadcast_jobs(self):
+        return await self.fetchall(SELECT_RUNNING_BROADCASTS)
+
+    async def get_broadcast_counts(self, job_id):
+        return {row[0]: row[1] for row in await self.fetchall(SELECT_BROADCAST_COUNTS, (job_id,))}
+
+    async def get_pending_broadcast_targets(self, job_id):
+        return [row[0] for row in await self.fetchall(SELECT_PENDING_TARGETS, (job_id,))]
+
+    async def set_broadcast_target_status(self, job_id, chat_id, status):
+        await self.write(UPDATE_BROADCAST_TARGET, (status, job_id, chat_id))
+
+    async def set_broadcast_job_status(self, job_id, status):
+        await self.write(UPDATE_BROADCAST_JOB, (status, job_id))
+
+    # Bring the stored assignments of a user in line with a fresh Moodle
+    # fetch. Only rows whose timemodified changed are rewritten; the
+    # returned diff lists what was added, moved to a new due date or removed.
+    # Stored assignments of `failed_course_ids`, whose fetch failed, are kept.
+    async def sync_assignments(self, chat_id, courses, assignments, failed_course_ids=()):
+        await self.write(UPSERT_COURSE, [(course['id'], course['fullname']) for course in courses], many=True)
+
+        stored = {row['assignment_id']: row for row in await self.fetchall(SELECT_ASSIGNMENT_VERSIONS, (chat_id,))}
+        fetched_ids = {assignment.id for assignment in assignments}
+        changed = [assignment for assignment in assignments
+                   if assignment.id not in stored
+                   or stored[assignment.id]['timemodified'] != assignment.timemodified]
+        removed = [assignment_id for assignment_id, row in stored.items()
+                   if assignment_id not in fetched_ids and row['course_id'] not in failed_course_ids]
+
+        if changed:
+            await self.write(UPSERT_ASSIGNMENT, [
+                (chat_id, assignment.id, assignment.course_id, assignment.name,
+                 assignment.duedate, assignment.timemodified)
+                for assignment in changed
+            ], many=True)
+        if removed:
+            await self.write(DELETE_ASSIGNMENT, [(chat_id, assignment_id) for assignment_id in removed], many=True)
+        await self.write(UPDATE_SYNCED_AT, (int(time.time()), chat_id))
+
+        return {
+            'added': [assignment for assignment in changed if assignment.id not in stored],
+            'moved': [assignment for assignment in changed
+                      if assignment.id in stored and stored[assignment.id]['duedate'] != assignment.duedate],
+            'removed': removed,
+        }
+
+    async def get_upcoming_assignments(self, chat_id, current_timestamp):
+        return await self.fetchall(SELECT_UPCOMING_ASSIGNMENTS, (chat_id, current_timestamp))
+
+    async def get_fsm_record(self, key):
+        return await self.fetchone(SELECT_FSM_RECORD, (key,))
+
+    async def save_fsm_records(self, upserts, deletes):
+        if upserts:
+            await self.write(UPSERT_FSM_RECORD, upserts, many=True)
+        if deletes:
+            await self.write(DELETE_FSM_RECORD, deletes, many=True)
+
+    async def purge_fsm_records(self, updated_before):
+        await self.write(DELETE_EXPIRED_FSM_RECORDS, (updated_before,))
+
+    async def add_manual_course(self, chat_id, name, credits, percentage):
+        await self.write(INSERT_MANUAL_COURSE, (chat_id, name, credits, percentage))
+
+    async def get_manual_courses(self, chat_id):
+        return await self.fetchall(SELECT_MANUAL_COURSES, (chat_id,))
+
+    async def clear_manual_courses(self, chat_id):
+        await self.write(DELETE_MANUAL_COURSES, (chat_id,))
+
+    async def count_fsm_states(self, updated_after):
+        return {row[0]: row[1] for row in await self.fetchall(COUNT_FSM_STATES, (updated_after,))}
+
+    async def count_chats(self):
+        row = await self.fetchone(COUNT_CHATS)
+        return {'private': row[0], 'group': row[1]}
@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import re
+import secrets
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from aiogram.types import InlineQueryResultArticle, InputTextMessageContent
+
+
+EXAM_TERMS = ['midterm', 'endterm']
+EXAM_NAMES = re.compile('|'.join(EXAM_TERMS), re.IGNORECASE)
+
+
+# Assignments of the user's courses for the assignment store, exams left
+# out and sorted by due date. Only static facts are kept; "time left" is
+# worked out at render time.
+def collect_deadlines(courses, assignments_by_course):
+    deadlines = [
+        assignment
+        for course in courses
+        for assignment in assignments_by_course.get(course['id'], [])
+        if not EXAM_NAMES.search(assignment.name)
+    ]
+    deadlines.sort(key=lambda assignment: assignment.duedate)
+    return deadlines
+
+
+MESSAGE_LIMIT = 4096
+# Longest "time left" text render() can produce, e.g. "23 hours, 59 minutes left"
+TIME_LEFT_WIDTH = 30
+
+
+def format_time_left(due_date, current_time):
+    time_left = due_date - current_time
+    days_left = time_left.days
+    hours_left, remainder = divmod(time_left.seconds, 3600)
+    minutes_left = remainder // 60
+
+    if days_left < 1:
+        return f"{hours_left} hours, {minutes_left:02d} minutes left"
+    return f"{days_left} days left"
+
+
+# Deadline list formatted once and split into pages.
+# Everything except the "time left" text is pre-rendered; pages are cut so
+# that even the longest time-left text keeps each page within Telegram's
+# message limit, and turning a page only fills in those few characters.
+class DeadlineView:
+    __slots__ = ('entries', 'pages')
+
+    def __init__(self, deadlines, page_entries=10, page_chars=MESSAGE_LIMIT):
+        self.entries = []
+        self.pages = []
+
+        page_start = 0
+        page_length = 0
+        for index, assignment in enumerate(deadlines, start=1):
+            due_date = datetime.fromtimestamp(assignment['duedate']) + timedelta(hours=2)
+            head = f"{index}. {due_date.strftime('%d %B %H:%M:%S')} ("
+            tail = f")\n📝 {assignment['name']} is due - {assignment['course']}\n"
+            self.entries.append((assignment['duedate'], due_date, head, tail))
+
+            length = len(head) + TIME_LEFT_WIDTH + len(tail) + 1
+            entries_on_page = len(self.entries) - 1 - page_start
+            if entries_on_page and (entries_on_page >= page_entries or page_length + length > page_chars):
+                self.pages.append((page_start, len(self.entries) - 1))
+                page_start, page_length = len(self.entries) - 1, 0
+            page_length += length
+
+        if len(self.entries) > page_start:
+            self.pages.append((page_start, len(self.entries)))
+
+    def render(self, page, current_timestamp):
+        start, end = self.pages[page]
+        current_time = datetime.fromtimestamp(current_timestamp)
+        return "\n".join(
+            f"{head}{format_time_left(due_date, current_time)}{tail}"
+            for duedate, due_date, head, tail in self.entries[start:end]
+            if duedate >= current_timestamp
+        )
+
+
+# Recently sent deadline views, so page buttons can be served from memory.
+# Ids are random, so a button from an earlier run or another worker never
+# resolves, and a view is only handed out to the chat it was sent to.
+class DeadlineViews:
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._views = OrderedDict()
+
+    def add(self, chat_id, view):
+        view_id = secrets.token_hex(8)
+        self._views[view_id] = (chat_id, view)
+        while len(self._views) > self.max_size:
+            self._views.popitem(last=False)
+        return view_id
+
+    def get(self, chat_id, view_id):
+        entry = self._views.get(view_id)
+        if entry is None or entry[0] != chat_id:
+            return None
+        self._views.move_to_end(view_id)
+        return entry[1]
+
+
+# Deadlines of a user as ready-made inline query results.
+# Articles and their search words are built once; answering a query only
+# filters them by prefix and drops deadlines that have passed.
+class DeadlineArticles:
+    __slots__ = ('built_at', 'entries')
+
+    def __init__(self, deadlines):
+        self.built_at = time.monotonic()
+        self.entries = []
+        for assignment in deadlines:
+            due_date = datetime.fromtimestamp(assignment['duedate']) + timedelta(hours=2)
+            due = due_date.strftime('%d %B %H:%M')
+            article = InlineQueryResultArticle(
+                id=str(assignment['id']),
+                title=assignment['name'],
+                description=f"{assignment['course']}\nDue {due}",
+                input_message_content=InputTextMessageContent(
+                    message_text=f"📝 {assignment['name']} is due {due} - {assignment['course']}"
+                ),
+            )
+            text = f"{assignment['name']} {assignment['course']}".lower()
+            self.entries.append((assignment['duedate'], text, tuple(text.split()), article))
+
+    # Articles whose name or course (or a word of them) starts with `query`
+    def search(self, query, current_timestamp):
+        query = query.strip().lower()
+        return [
+            article for duedate, text, words, article in self.entries
+            if duedate >= current_timestamp
+            and (not query or text.startswith(query) or any(word.startswith(query) for word in words))
+        ]
+
+
+# Recently built DeadlineArticles per user, rebuilt after `ttl` seconds
+class InlineDeadlines:
+    def __init__(self, ttl=300, max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._articles = OrderedDict()
+
+    def get(self, key):
+        articles = self._articles.get(key)
+        if articles is None or time.monotonic() - articles.built_at >= self.ttl:
+            return None
+        self._articles.move_to_end(key)
+        return articles
+
+    def add(self, key, articles):
+        self._articles[key] = articles
+        self._articles.move_to_end(key)
+        while len(self._articles) > self.max_size:
+            self._articles.popitem(last=False)
+
+    def invalidate(self, key):
+        self._articles.pop(key, None)
+
+
+# Per-user cache of loader results.
+# Entries younger than `ttl` are served as is. Older entries (up to
+# `max_age`) are still served, but trigger one background refresh.
+# Anything older is reloaded before answering, unless the caller passes
+# wait=False and can make do without it. Least recently used entries
+# are evicted once `max_size` is reached.
+#
+# A background refresh failing with one of `reload_errors` (e.g. a revoked
+# token) makes the next get wait for a reload, so the error reaches a
+# caller instead of stale data being served on.
+class DeadlineCache:
+    def __init__(self, loader, ttl=300, max_age=3600, max_size=1000, reload_errors=()):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_age = max_age
+        self.max_size = max_size
+        self.reload_errors = reload_errors
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._failed = OrderedDict()
+
+    async def get(self, key, *args, wait=True):
+        failed = self._failed.pop(key, None) is not None
+        entry = self._entries.get(key)
+        if entry is not None and not failed:
+            loaded_at, value = entry
+            age = time.monotonic() - loaded_at
+            if age < self.max_age:
+                self._entries.move_to_end(key)
+                if age >= self.ttl:
+                    self._refresh(key, *args)
+                return value
+
+        task = self._refresh(key, *args)
+        if not wait and not failed:
+            return entry[1] if entry is not None else None
+        return await asyncio.shield(task)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+        self._failed.pop(key, None)
+
+    def _refresh(self, key, *args):
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, *args))
+            task.add_done_callback(self._log_failure)
+            self._pending[key] = task
+        return task
+
+    async def _load(self, key, *args):
+        try:
+            value = await self.loader(*args)
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return value
+        except self.reload_errors:
+            self._failed[key] = True
+            while len(self._failed) > self.max_size:
+                self._failed.popitem(last=False)
+            raise
+        finally:
+            self._pending.pop(key, None)
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Cache refresh failed: {task.exception()}")
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from deadlines import MESSAGE_LIMIT, DeadlineView
+
+# Room left on the first page for the digest header and footer
+HEADER_ROOM = 200
+
+
+# Scheduled deadline digests for group chats.
+#
+# A group opts in with /digest, linking the deadlines of one registered
+# member. The digest is rebuilt once per interval from that member's
+# deadlines and posted to the group (pinned when first sent, edited in
+# place afterwards). /deadlines in the group is answered from the same
+# member's deadlines, so members no longer hit Moodle one by one. Views
+# are built from the assignment store on every request (the Moodle sync
+# behind it is cached), so passed deadlines never linger on page 1.
+class GroupDigests:
+    def __init__(self, bot, db, fetch, page_entries=10, check_interval=60):
+        self.bot = bot
+        self.db = db
+        self.fetch = fetch
+        self.page_entries = page_entries
+        self.check_interval = check_interval
+        self._building = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def start(self, owns_chat=None):
+        self._task = asyncio.create_task(self._run(owns_chat))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def enable(self, group_id, user_chat_id, interval):
+        await self.db.enable_digest(group_id, user_chat_id, interval)
+        self._wakeup.set()
+
+    async def disable(self, group_id):
+        await self.db.disable_digest(group_id)
+
+    # Current digest of the group, or None if it has none or the linked
+    # member has no deadlines to show (e.g. is no longer registered)
+    async def get_view(self, group_id):
+        digest = await self.db.get_group_digest(group_id)
+        if digest is None:
+            return None
+        return await self._build(digest)
+
+    # Members asking at the same time share one build
+    async def _build(self, digest):
+        group_id = digest['chat_id']
+        task = self._building.get(group_id)
+        if task is None:
+            task = asyncio.create_task(self._load(digest))
+            self._building[group_id] = task
+            task.add_done_callback(lambda _: self._building.pop(group_id, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, digest):
+        deadlines = await self.fetch(digest['digest_user_id'])
+        if deadlines is None:
+            return None
+        return DeadlineView(deadlines, page_entries=self.page_entries,
+                            page_chars=MESSAGE_LIMIT - HEADER_ROOM)
+
+    async def _run(self, owns_chat):
+        while True:
+            for digest in await self.db.get_due_digests(int(time.time())):
+                if owns_chat is not None and not owns_chat(digest['chat_id']):
+                    continue
+                try:
+                    await self._publish(digest)
+                except Exception as e:
+                    logging.error(f"Failed to publish digest for {digest['chat_id']}: {e}")
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.check_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _publish(self, digest):
+        group_id = digest['chat_id']
+        view = await self._load(digest)
+        if view is None:
+            if await self.db.get_user(digest['digest_user_id']) is None:
+                logging.info(f"Linked member of {group_id} is no longer registered, turning its digest off")
+                await self.disable(group_id)
+            else:
+                # No courses yet, try again next interval
+                await self.db.update_digest(group_id, digest['digest_message_id'], int(time.time()))
+            return
+        current_timestamp = int(time.time())
+        text = (
+            f"📌 Deadlines digest, updated {datetime.now().strftime('%d.%m %H:%M')}\n\n"
+            + (view.render(0, current_timestamp) or "No upcoming deadlines.")
+        )
+        if len(view.pages) > 1:
+            text += "\n\nSend /deadlines for the full list."
+
+        message_id = digest['digest_message_id']
+        try:
+            if message_id is not None:
+                try:
+                    await self.bot.edit_message_text(text=text, chat_id=group_id, message_id=message_id)
+                except TelegramBadRequest as e:
+                    if 'not modified' not in e.message.lower():
+                        # The old digest was deleted, post a new one
+                        message_id = None
+
+            if message_id is None:
+                message = await self.bot.send_message(group_id, text)
+                message_id = message.message_id
+                try:
+                    await self.bot.pin_chat_message(group_id, message_id, disable_notification=True)
+                except (TelegramBadRequest, TelegramForbiddenError):
+                    # Pinning needs admin rights, the digest is posted anyway
+                    pass
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            if isinstance(e, TelegramBadRequest) and 'chat not found' not in e.message.lower():
+                raise
+            logging.info(f"Bot was removed from {group_id}, dropping its digest")
+            await self.db.delete_group_chat_id(group_id)
+            return
+
+        await self.db.update_digest(group_id, message_id, current_timestamp)
@@ -0,0 +1,194 @@
+import asyncio
+import html
+import re
+from collections import OrderedDict, namedtuple
+
+
+# Register grades as AITU names them in the gradebook,
+# e.g. "Register Midterm", "Register Mid-Term", "Register End-Term"
+REGISTER_MIDTERM = re.compile(r'register\s*mid[\s-]*term', re.IGNORECASE)
+REGISTER_ENDTERM = re.compile(r'register\s*end[\s-]*term', re.IGNORECASE)
+
+COURSE_NAME_WIDTH = 18
+
+
+# Only the fields the calculators read are kept in the grade cache
+GRADE_ITEM_FIELDS = ('id', 'itemname', 'itemtype', 'graderaw', 'grademax')
+
+
+def prune_grade_items(items):
+    return [{field: item.get(field) for field in GRADE_ITEM_FIELDS} for item in items]
+
+
+def item_percentage(item):
+    raw, maximum = item.get('graderaw'), item.get('grademax')
+    if raw is None or not maximum:
+        return None
+    return raw / maximum * 100
+
+
+# (midterm, endterm) percentages found among a course's grade items,
+# None for a register grade that is missing or not graded yet
+def register_grades(items):
+    midterm = endterm = None
+    for item in items:
+        name = item.get('itemname') or ''
+        if midterm is None and REGISTER_MIDTERM.search(name):
+            midterm = item_percentage(item)
+        elif endterm is None and REGISTER_ENDTERM.search(name):
+            endterm = item_percentage(item)
+    return midterm, endterm
+
+
+# Final exam percentage needed to avoid a retake (>50), keep the
+# scholarship (>70) and get the high scholarship (>90). The final exam
+# is 40% of the total and has to be passed with at least 50%.
+def scholarship_thresholds(midterm, endterm):
+    current_grade = 0.3 * midterm + 0.3 * endterm
+    return {
+        'current': current_grade,
+        'retake': max(50, (50 - current_grade) / 0.4),
+        'scholarship': max(50, (70 - current_grade) / 0.4),
+        'high_scholarship': max(0, (90 - current_grade) / 0.4),
+        'if_100_final': current_grade + 0.4 * 100,
+    }
+
+
+# Thresholds for every course in one pass. `courses` is a list of
+# (course name, midterm, endterm); courses without both register grades
+# get None instead of thresholds.
+def batch_thresholds(courses):
+    return [
+        (name, midterm, endterm,
+         scholarship_thresholds(midterm, endterm) if midterm is not None and endterm is not None else None)
+        for name, midterm, endterm in courses
+    ]
+
+
+def _format_required(value):
+    return str(int(value)) if value <= 100 else "✗"
+
+
+def _format_grade(value):
+    return "—" if value is None else f"{value:.0f}"
+
+
+# One monospace table (HTML parse mode) with a row per course
+def format_scholarship_table(rows):
+    lines = [f"{'Course':<{COURSE_NAME_WIDTH}} {'Mid':>3} {'End':>3} {'>50':>4} {'>70':>4} {'>90':>4}"]
+    for name, midterm, endterm, thresholds in rows:
+        name = name if len(name) <= COURSE_NAME_WIDTH else name[:COURSE_NAME_WIDTH - 1] + '…'
+        line = f"{name:<{COURSE_NAME_WIDTH}} {_format_grade(midterm):>3} {_format_grade(endterm):>3}"
+        if thresholds is None:
+            line += "   no grades yet"
+        else:
+            line += "".join(f" {_format_required(thresholds[key]):>4}"
+                            for key in ('retake', 'scholarship', 'high_scholarship'))
+        lines.append(line)
+    return "<pre>" + html.escape("\n".join(lines)) + "</pre>"
+
+
+# AITU letter scale: (lowest percentage, letter, GPA points)
+GPA_SCALE = (
+    (95, 'A', 4.0),
+    (90, 'A-', 3.67),
+    (85, 'B+', 3.33),
+    (80, 'B', 3.0),
+    (75, 'B-', 2.67),
+    (70, 'C+', 2.33),
+    (65, 'C', 2.0),
+    (60, 'C-', 1.67),
+    (55, 'D+', 1.33),
+    (50, 'D', 1.0),
+    (25, 'FX', 0.0),
+    (0, 'F', 0.0),
+)
+
+CourseGrade = namedtuple('CourseGrade', 'name percentage letter points credits')
+
+
+def letter_grade(percentage):
+    for lowest, letter, points in GPA_SCALE:
+        if percentage >= lowest:
+            return letter, points
+    return 'F', 0.0
+
+
+# Course total of a gradebook, None while the course is not graded
+def course_total(items):
+    for item in items:
+        if item.get('itemtype') == 'course':
+            return item_percentage(item)
+    return None
+
+
+def course_grade(name, percentage, credits):
+    if percentage is None:
+        return CourseGrade(name, None, None, None, credits)
+    return CourseGrade(name, percentage, *letter_grade(percentage), credits)
+
+
+# Credit-weighted GPA over graded courses, None if nothing is graded
+def gpa(grades):
+    graded = [grade for grade in grades if grade.points is not None and grade.credits]
+    credits = sum(grade.credits for grade in graded)
+    if not credits:
+        return None
+    return sum(grade.points * grade.credits for grade in graded) / credits
+
+
+def format_gpa_table(grades):
+    lines = [f"{'Course':<{COURSE_NAME_WIDTH}} {'%':>3} {'Gr':<2} {'Pts':>4} {'Cr':>3}"]
+    for grade in grades:
+        name = grade.name if len(grade.name) <= COURSE_NAME_WIDTH else grade.name[:COURSE_NAME_WIDTH - 1] + '…'
+        if grade.points is None:
+            lines.append(f"{name:<{COURSE_NAME_WIDTH}}   not graded yet")
+        else:
+            lines.append(f"{name:<{COURSE_NAME_WIDTH}} {grade.percentage:>3.0f} {grade.letter:<2} "
+                         f"{grade.points:>4.2f} {grade.credits:>3g}")
+    return "<pre>" + html.escape("\n".join(lines)) + "</pre>"
+
+
+# Per-course GPA results kept between requests.
+#
+# Every request starts from one cheap overview call giving the final
+# grade of each course (`signatures`). Only courses whose signature
+# changed since the last request, or that were never computed, have
+# their gradebook loaded again through `load_items(user, course_id,
+# refresh)`; all other courses reuse the stored result. Results for the
+# `max_users` most recent users are kept.
+class GpaEngine:
+    def __init__(self, load_items, credits=5, max_users=1000):
+        self.load_items = load_items
+        self.credits = credits
+        self.max_users = max_users
+        self._results = OrderedDict()
+
+    # CourseGrade for every course in `courses` (dicts with id and
+    # fullname). Without signatures every course is loaded, but nothing
+    # is forced past the item cache.
+    async def grades(self, key, user, courses, signatures=None):
+        cached = self._results.get(key, {})
+        changed = [
+            course for course in courses
+            if signatures is None or course['id'] not in cached
+            or cached[course['id']][0] != signatures.get(course['id'])
+        ]
+        items = await asyncio.gather(*(
+            self.load_items(user, course['id'], signatures is not None and course['id'] in cached)
+            for course in changed
+        ))
+
+        results = {course['id']: cached[course['id']] for course in courses if course['id'] in cached}
+        for course, course_items in zip(changed, items):
+            signature = signatures.get(course['id']) if signatures is not None else None
+            results[course['id']] = (signature, course_grade(course['fullname'], course_total(course_items), self.credits))
+
+        self._results[key] = results
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_users:
+            self._results.popitem(last=False)
+        return [results[course['id']][1] for course in courses]
+
+    def forget(self, key):
+        self._results.pop(key, None)
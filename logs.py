@@ -0,0 +1,140 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+
+
+# (chat_id, handler name, perf_counter at start) of the update being handled
+log_context = ContextVar('log_context', default=None)
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s%(context)s: %(message)s'
+
+# Numbers (chat ids, message ids, retry delays) don't make two errors different
+NUMBERS = re.compile(r'-?\d+')
+
+
+@contextmanager
+def request_context(chat_id=None, handler=None):
+    token = log_context.set((chat_id, handler, time.perf_counter()))
+    try:
+        yield
+    finally:
+        log_context.reset(token)
+
+
+# Copies the current request context onto every record as chat_id,
+# handler and elapsed (ms since the handler started), plus a ready to
+# print `context` suffix for the text format.
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        context = log_context.get()
+        if context is None:
+            record.chat_id = record.handler = record.elapsed = None
+            record.context = ''
+            return True
+
+        chat_id, handler, started = context
+        record.chat_id = chat_id
+        record.handler = handler
+        record.elapsed = round((time.perf_counter() - started) * 1000, 1)
+        record.context = f" [chat_id={chat_id} handler={handler} elapsed={record.elapsed}ms]"
+        return True
+
+
+# Lets at most `burst` similar warnings and errors through per `interval`
+# seconds. Messages are similar when they only differ in numbers, so one
+# "Failed to send message to <chat>" line per chat during a broadcast
+# becomes a few lines and a count: the first similar message after the
+# window carries how many were dropped.
+class RateLimitFilter(logging.Filter):
+    def __init__(self, interval=60, burst=5, max_keys=1000):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> [window start, messages in window, suppressed in window]
+        self._windows = {}
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+
+        key = (record.name, record.levelno, NUMBERS.sub('N', str(record.msg)))
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            if window is None and len(self._windows) >= self.max_keys:
+                self._windows.clear()
+            suppressed = window[2] if window is not None else 0
+            self._windows[key] = [now, 1, 0]
+            if suppressed:
+                record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+            return True
+
+        if window[1] < self.burst:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        # Tracebacks are already part of the message, QueueHandler merges them
+        for field in ('chat_id', 'handler', 'elapsed'):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# Routes all logging through an unbounded queue. The event loop only
+# formats the record and puts it on the queue; a QueueListener thread
+# does the actual writing. Context and rate limiting are applied before
+# enqueueing, where the request's context variables are still visible.
+def setup_logging(level=logging.INFO, fmt='text', rate_interval=60, rate_burst=5):
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(ContextFilter())
+    handler.addFilter(RateLimitFilter(rate_interval, rate_burst))
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, stream)
+    listener.start()
+    # Write out whatever is still queued when the process exits
+    atexit.register(listener.stop)
+    return listener
+
+
+# Sets the request context for the handlers of the observer it is
+# attached to. Register it before other middlewares so their log lines
+# carry the context too.
+class LogContextMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        chat = data.get('event_chat')
+        user = data.get('event_from_user')
+        command = data.get('text_command')
+        name = (command or data['handler']).callback.__name__
+        with request_context(chat.id if chat else user.id if user else None, name):
+            return await handler(event, data)
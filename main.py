@@ -1,33 +1,196 @@
-import aiohttp
-import aiosqlite
 import asyncio
+import html
 import logging
-from datetime import datetime, timedelta
+import shutil
+import signal
+import tempfile
+import time
+from datetime import datetime
 from dotenv import load_dotenv
 import os
 
-from aiogram import Bot, Dispatcher, Router,types, F
+from aiogram import Bot, Dispatcher, Router,types, F, flags
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import FSInputFile, Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup,InlineKeyboardButton,ReplyKeyboardRemove
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
-from aiogram.filters import Command  
+from aiogram.filters import Command, CommandObject
 from aiogram.filters.state import StateFilter
 
+from database import Database
+from deadlines import DeadlineArticles, DeadlineCache, DeadlineView, DeadlineViews, InlineDeadlines, collect_deadlines
+from broadcast import Broadcaster
+from digests import GroupDigests
+from logs import LogContextMiddleware, setup_logging
+from grades import (GpaEngine, batch_thresholds, course_grade, format_gpa_table, format_scholarship_table, gpa,
+                    prune_grade_items, register_grades, scholarship_thresholds)
+from menu import TextCommands
+from metrics import HandlerMetricsMiddleware, Registry, start_metrics_server
+from moodle import CircuitBreaker, InvalidTokenError, MoodleClient, MoodleError, MoodleUnavailableError
+from reminders import ReminderScheduler
+from storage import SQLiteStorage
+from throttling import ThrottlingMiddleware
+from webhook import run_webhook
+from workers import HashRing, Supervisor, serve_updates
+
 # Load environment variables
 load_dotenv()
 BOT_TOKEN = os.getenv('TEL_API_TOKEN')
 MOODLE_URL = os.getenv('REQUEST_URL')
 ADMIN_ID = int(os.getenv('ADMIN_ID'))
+DB_PATH = os.getenv('DB_PATH', 'users.db')
+
+# Update delivery: 'polling' (default) or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', 30))
+if BOT_MODE not in ('polling', 'webhook'):
+    raise SystemExit(f"BOT_MODE must be 'polling' or 'webhook', got {BOT_MODE!r}")
+if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+    raise SystemExit("BOT_MODE=webhook needs WEBHOOK_URL, the public HTTPS address Telegram posts updates to")
+
+# Worker processes; more than 1 shards update handling by chat_id
+WORKERS = int(os.getenv('WORKERS', 1))
+# Alternative Bot API server, e.g. a local stub for testing
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+# Moodle HTTP client tuning
+MOODLE_POOL_SIZE = int(os.getenv('MOODLE_POOL_SIZE', 100))
+MOODLE_POOL_PER_HOST = int(os.getenv('MOODLE_POOL_PER_HOST', 20))
+MOODLE_DNS_TTL = int(os.getenv('MOODLE_DNS_TTL', 300))
+MOODLE_KEEPALIVE = float(os.getenv('MOODLE_KEEPALIVE', 30))
+MOODLE_TIMEOUT = float(os.getenv('MOODLE_TIMEOUT', 30))
+MOODLE_CONNECT_TIMEOUT = float(os.getenv('MOODLE_CONNECT_TIMEOUT', 10))
+MOODLE_READ_TIMEOUT = float(os.getenv('MOODLE_READ_TIMEOUT', 10))
+# Retries per call on transport errors, and failures in a row that open the breaker for BREAKER_RESET seconds
+MOODLE_MAX_RETRIES = int(os.getenv('MOODLE_MAX_RETRIES', 2))
+MOODLE_BREAKER_THRESHOLD = int(os.getenv('MOODLE_BREAKER_THRESHOLD', 5))
+MOODLE_BREAKER_RESET = float(os.getenv('MOODLE_BREAKER_RESET', 30))
+MOODLE_ASSIGN_CHUNK = int(os.getenv('MOODLE_ASSIGN_CHUNK', 20))
+# Concurrent Moodle requests allowed per token
+MOODLE_PER_TOKEN_LIMIT = int(os.getenv('MOODLE_PER_TOKEN_LIMIT', 4))
+
+# Deadline cache: fresh for TTL seconds, served stale up to MAX_AGE
+DEADLINE_CACHE_TTL = float(os.getenv('DEADLINE_CACHE_TTL', 300))
+DEADLINE_CACHE_MAX_AGE = float(os.getenv('DEADLINE_CACHE_MAX_AGE', 3600))
+DEADLINE_CACHE_SIZE = int(os.getenv('DEADLINE_CACHE_SIZE', 1000))
+# Deadline messages: entries per page and how many sent lists keep working buttons
+DEADLINES_PAGE_SIZE = int(os.getenv('DEADLINES_PAGE_SIZE', 10))
+DEADLINE_VIEWS_SIZE = int(os.getenv('DEADLINE_VIEWS_SIZE', 1000))
+# Inline mode: seconds Telegram (and the bot) may reuse a user's results
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', 300))
+# Telegram accepts at most 50 results per answer
+INLINE_PAGE_SIZE = 50
+# Gradebook cache per course: fresh for TTL seconds, served stale up to MAX_AGE
+GRADE_CACHE_TTL = float(os.getenv('GRADE_CACHE_TTL', 600))
+GRADE_CACHE_MAX_AGE = float(os.getenv('GRADE_CACHE_MAX_AGE', 6 * 3600))
+GRADE_CACHE_SIZE = int(os.getenv('GRADE_CACHE_SIZE', 20000))
+# Credits assumed for Moodle courses in the GPA, which Moodle does not report
+GPA_DEFAULT_CREDITS = float(os.getenv('GPA_DEFAULT_CREDITS', 5))
+
+# Reminders: hours before a deadline, comma separated (empty disables them)
+REMINDER_OFFSETS = [int(float(hours) * 3600) for hours in os.getenv('REMINDER_OFFSETS', '24,3,1').split(',') if hours.strip()]
+REMINDER_REFRESH_INTERVAL = float(os.getenv('REMINDER_REFRESH_INTERVAL', 3600))
+REMINDER_CONCURRENCY = int(os.getenv('REMINDER_CONCURRENCY', 5))
+# Reminder messages per second and concurrent senders, kept below BROADCAST_RATE
+# so reminders and a running broadcast together stay under Telegram's ~30/s
+REMINDER_RATE = float(os.getenv('REMINDER_RATE', 5))
+REMINDER_SENDERS = int(os.getenv('REMINDER_SENDERS', 5))
+
+# Broadcasts: global messages per second and number of concurrent senders
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))
+BROADCAST_SENDERS = int(os.getenv('BROADCAST_SENDERS', 10))
+
+# Group digests: default hours between posts, and how often due digests are looked for
+GROUP_DIGEST_INTERVAL = float(os.getenv('GROUP_DIGEST_INTERVAL', 12))
+GROUP_DIGEST_CHECK_INTERVAL = float(os.getenv('GROUP_DIGEST_CHECK_INTERVAL', 60))
+
+# Throttling: requests per second and burst, per user and per group chat
+THROTTLE_USER_RATE = float(os.getenv('THROTTLE_USER_RATE', 1))
+THROTTLE_USER_BURST = int(os.getenv('THROTTLE_USER_BURST', 5))
+THROTTLE_CHAT_RATE = float(os.getenv('THROTTLE_CHAT_RATE', 3))
+THROTTLE_CHAT_BURST = int(os.getenv('THROTTLE_CHAT_BURST', 20))
+
+# FSM storage: records kept in memory, and age after which a state is abandoned
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 10000))
+FSM_STATE_TTL = float(os.getenv('FSM_STATE_TTL', 7 * 24 * 3600))
+
+# Logging: level, 'text' or 'json' lines, and how many similar warnings
+# or errors are written per interval (seconds) before they are counted instead
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_RATE_INTERVAL = float(os.getenv('LOG_RATE_INTERVAL', 60))
+LOG_RATE_BURST = int(os.getenv('LOG_RATE_BURST', 5))
+
+# Local metrics server: /metrics in Prometheus text format (0 disables it).
+# In multi-process mode worker N listens on METRICS_PORT + N.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9100))
+
+# Metrics, served on METRICS_PORT and summarised by the admin "Stats" button
+metrics = Registry()
+handler_latency = metrics.histogram('bot_handler_seconds', 'Handler latency', ('handler',))
+handler_errors = metrics.counter('bot_handler_errors_total', 'Handler exceptions', ('handler',))
+moodle_latency = metrics.histogram('moodle_request_seconds', 'Moodle web-service call latency', ('wsfunction',))
+moodle_errors = metrics.counter('moodle_request_errors_total', 'Failed Moodle calls', ('wsfunction', 'error'))
+db_latency = metrics.histogram('db_query_seconds', 'SQLite reads and committed write batches', ('kind',))
+broadcast_messages = metrics.counter('broadcast_messages_total', 'Processed broadcast targets', ('kind', 'status'))
+metrics_runner = None
+
+
+def record_moodle_call(wsfunction, seconds, error):
+    moodle_latency.observe(seconds, wsfunction)
+    if error:
+        moodle_errors.inc(wsfunction, error)
+
+
+# Shared database repository, opened in create_db()
+db = Database(DB_PATH, on_query=lambda kind, seconds: db_latency.observe(seconds, kind))
 
 # Initialize bot and dispatcher
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session)
+fsm_storage = SQLiteStorage(db, cache_size=FSM_CACHE_SIZE, ttl=FSM_STATE_TTL)
+dp = Dispatcher(storage=fsm_storage)
 router = Router()
+throttling = ThrottlingMiddleware(
+    user_rate=THROTTLE_USER_RATE,
+    user_burst=THROTTLE_USER_BURST,
+    chat_rate=THROTTLE_CHAT_RATE,
+    chat_burst=THROTTLE_CHAT_BURST,
+)
+log_context = LogContextMiddleware()
+for observer in (router.message, router.callback_query, router.my_chat_member, router.inline_query):
+    observer.middleware(log_context)
+router.message.middleware(throttling)
+router.callback_query.middleware(throttling)
+for observer in (router.message, router.callback_query, router.my_chat_member, router.inline_query):
+    observer.middleware(HandlerMetricsMiddleware(handler_latency, handler_errors))
+
+
+async def collect_fsm_states():
+    return {(state,): count for state, count in (await fsm_storage.count_states()).items()}
+
+
+async def collect_chats():
+    return {(kind,): count for kind, count in (await db.count_chats()).items()}
+
+
+metrics.gauge('fsm_states', 'Active conversations per FSM state', collect_fsm_states, ('state',))
+metrics.gauge('bot_chats', 'Registered users and group chats', collect_chats, ('kind',))
+
+# Shared Moodle client, created in main()
+moodle = None
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
+# Setup logging: records are written by a background thread, never by the event loop
+setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_RATE_INTERVAL, LOG_RATE_BURST)
 
 #User state
 class UserState(StatesGroup):
@@ -40,6 +203,13 @@ class ScholarshipStates(StatesGroup):
     waiting_for_second_attestation = State()
 
 
+#GPA state: a course added by hand
+class GpaStates(StatesGroup):
+    waiting_for_course_name = State()
+    waiting_for_credits = State()
+    waiting_for_grade = State()
+
+
 #Broadcast state 
 class BroadcastStates(StatesGroup):
     waiting_for_message = State()
@@ -48,119 +218,8 @@ class BroadcastStates(StatesGroup):
 
 # Database initialization
 async def create_db():
-    async with aiosqlite.connect('users.db') as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS user_tokens (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL UNIQUE,
-                first_name TEXT NOT NULL,
-                token TEXT NOT NULL
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS group_chat (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL UNIQUE
-            )
-        ''')
-        await db.commit()
-
-async def store_token(chat_id, first_name, token):
-    async with aiosqlite.connect('users.db') as db:
-        await db.execute('''
-            INSERT OR REPLACE INTO user_tokens (chat_id, first_name, token)
-            VALUES (?, ?, ?)
-        ''', (chat_id, first_name, token))
-        await db.commit()
-
-async def get_token(chat_id):
-    async with aiosqlite.connect('users.db') as db:
-        cursor = await db.execute('SELECT token FROM user_tokens WHERE chat_id = ?', (chat_id,))
-        result = await cursor.fetchone()
-        return result[0] if result else None
-
-async def store_group_chat_id(chat_id):
-    async with aiosqlite.connect('users.db') as db:
-        try:
-            await db.execute('INSERT INTO group_chat (chat_id) VALUES (?)', (chat_id,))
-            await db.commit()
-        except aiosqlite.IntegrityError:
-            logging.info(f"Group chat {chat_id} already stored")
-
-async def get_all_group_chat_ids():
-    async with aiosqlite.connect('users.db') as db:
-        cursor = await db.execute('SELECT chat_id FROM group_chat')
-        return [row[0] for row in await cursor.fetchall()]
-    
-async def get_users_id():
-    async with aiosqlite.connect('users.db') as db:
-        cursor = await db.execute('SELECT chat_id FROM user_tokens')
-        return [user_id[0] for user_id in await cursor.fetchall()]
-
-
+    await db.open()
 
-async def is_user_registered(chat_id):
-    async with aiosqlite.connect('users.db') as db:
-
-        cursor = await db.execute('SELECT * FROM user_tokens WHERE chat_id = ?', (chat_id,))
-        user = await cursor.fetchone()
-        return user is not None
-
-
-
-async def delete_token(chat_id):
-    try:
-        async with aiosqlite.connect('users.db') as db:
-            await db.execute('DELETE FROM user_tokens WHERE chat_id = ?', (chat_id,))
-            await db.commit()
-    except Exception as e:
-        print(f"Error deleting token for {chat_id}: {e}")
-
-
-async def verify_security_key(token):
-    params = {
-        'wstoken': token,
-        'wsfunction': 'core_webservice_get_site_info',
-        'moodlewsrestformat': 'json'
-    }
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(MOODLE_URL, params=params) as response:
-                data = await response.json()
-                return data.get('userid')
-    except aiohttp.ClientError as e:
-        logging.error(f"Error verifying token: {e}")
-        return None
-
-async def get_courses(token, user_id):
-    params = {
-        'wstoken': token,
-        'wsfunction': 'core_enrol_get_users_courses',
-        'moodlewsrestformat': 'json',
-        'userid': user_id
-    }
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(MOODLE_URL, params=params) as response:
-                return await response.json()
-        except aiohttp.ClientError as e:
-            logging.error(f"Error retrieving courses: {e}")
-            return []
-
-async def get_assignments(token, course_id):
-    params = {
-        'wstoken': token,
-        'wsfunction': 'mod_assign_get_assignments',
-        'courseids[0]': course_id,
-        'moodlewsrestformat': 'json'
-    }
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(MOODLE_URL, params=params) as response:
-                return await response.json()
-        except aiohttp.ClientError as e:
-            logging.error(f"Error retrieving assignments: {e}")
-            return {}
 
 """
 def time_remaining(due_date):
@@ -194,7 +253,7 @@ async def main_menu(message):
 
 async def adm_btn(message):
     builder = ReplyKeyboardBuilder()
-    builder.row(KeyboardButton(text="Users"),KeyboardButton(text="Broadcast"))
+    builder.row(KeyboardButton(text="Users"),KeyboardButton(text="Broadcast"),KeyboardButton(text="Stats"))
     builder.row(KeyboardButton(text="Exit"))
     
     await message.answer("Choose an action:", reply_markup=builder.as_markup(resize_keyboard=True))
@@ -209,83 +268,317 @@ async def broadcast_btn(message):
     await message.answer("Choose an action:", reply_markup=builder.as_markup(resize_keyboard=True))
 
 
-async def show_deadlines(message, token):
-    user_id = await verify_security_key(token)
-    courses = await get_courses(token, user_id)
-    
+# Moodle userid for a stored user, re-resolved from site info only when
+# the stored one is missing or Moodle rejected the token
+async def resolve_moodle_user_id(user, refresh=False):
+    if user['moodle_user_id'] is not None and not refresh:
+        return user['moodle_user_id']
+
+    try:
+        site_info = await moodle.get_site_info(user['token'])
+    except MoodleUnavailableError:
+        if user['moodle_user_id'] is None:
+            raise
+        return user['moodle_user_id']
+
+    await db.update_site_info(user['chat_id'], site_info.get('userid'), site_info.get('timezone'))
+    return site_info.get('userid')
+
+
+# Pull the user's assignments from Moodle into the local store.
+# Returns the diff against what was stored, or None if the user has no courses.
+async def sync_deadlines(user):
+    token = user['token']
+    user_id = await resolve_moodle_user_id(user)
+    try:
+        courses = await moodle.get_courses(token, user_id)
+    except InvalidTokenError:
+        user_id = await resolve_moodle_user_id(user, refresh=True)
+        courses = await moodle.get_courses(token, user_id)
+
     if not courses:
-        await message.answer("No courses found.")
+        return None
+
+    assignments = await moodle.get_assignments(token, [course['id'] for course in courses])
+    failed_course_ids = {course['id'] for course in courses} - assignments.keys()
+    diff = await db.sync_assignments(user['chat_id'], courses, collect_deadlines(courses, assignments),
+                                     failed_course_ids)
+    if diff['added'] or diff['moved'] or diff['removed']:
+        logging.info(f"Deadlines for {user['chat_id']}: {len(diff['added'])} new, "
+                     f"{len(diff['moved'])} moved, {len(diff['removed'])} removed")
+    return diff
+
+
+# Moodle syncs per token, redone in the background once stale
+deadline_cache = DeadlineCache(
+    sync_deadlines,
+    ttl=DEADLINE_CACHE_TTL,
+    max_age=DEADLINE_CACHE_MAX_AGE,
+    max_size=DEADLINE_CACHE_SIZE,
+    reload_errors=(InvalidTokenError,),
+)
+
+
+# Pre-rendered deadline lists behind the page buttons
+deadline_views = DeadlineViews(DEADLINE_VIEWS_SIZE)
+
+
+# Upcoming deadlines from the assignment store, or None if the user has no
+# courses. Only a user who was never synced has to wait for Moodle; everyone
+# else is answered from the store while a stale sync runs in the background,
+# or with what was synced last while Moodle is unavailable. A token that
+# Moodle rejected in a background sync is reported on the next request.
+async def get_upcoming_deadlines(user, wait=False):
+    never_synced = user['synced_at'] is None
+    try:
+        diff = await deadline_cache.get(user['token'], user, wait=wait or never_synced)
+    except MoodleUnavailableError:
+        if never_synced:
+            raise
+        diff = None
+    if never_synced and diff is None:
+        return None
+    return await db.get_upcoming_assignments(user['chat_id'], int(datetime.now().timestamp()))
+
+
+async def load_grade_items(token, user_id, course_id):
+    return prune_grade_items(await moodle.get_grade_items(token, user_id, course_id))
+
+
+# Gradebook items per (token, course), shared by the grade calculators
+grade_cache = DeadlineCache(
+    load_grade_items,
+    ttl=GRADE_CACHE_TTL,
+    max_age=GRADE_CACHE_MAX_AGE,
+    max_size=GRADE_CACHE_SIZE,
+)
+
+
+# [(course, grade items)] for every course the user is enrolled in, or
+# None if there are none. Courses are fetched concurrently.
+async def get_course_grades(user):
+    token = user['token']
+    user_id = await resolve_moodle_user_id(user)
+    courses = await moodle.get_courses(token, user_id)
+    if not courses:
+        return None
+
+    items = await asyncio.gather(*(
+        grade_cache.get((token, course['id']), token, user_id, course['id']) for course in courses
+    ))
+    return list(zip(courses, items))
+
+
+async def load_course_items(moodle_user, course_id, refresh):
+    token, user_id = moodle_user
+    if refresh:
+        grade_cache.invalidate((token, course_id))
+    return await grade_cache.get((token, course_id), token, user_id, course_id)
+
+
+# Per-course GPA results, recomputed only for courses whose grade changed
+gpa_engine = GpaEngine(load_course_items, credits=GPA_DEFAULT_CREDITS)
+
+
+async def get_gpa_grades(user):
+    token = user['token']
+    user_id = await resolve_moodle_user_id(user)
+    courses, signatures = await asyncio.gather(
+        moodle.get_courses(token, user_id),
+        moodle.get_course_overview(token, user_id),
+    )
+    if not courses:
+        return []
+    return await gpa_engine.grades(token, (token, user_id), courses, signatures)
+
+
+async def fetch_user_deadlines(chat_id):
+    user = await db.get_user(chat_id)
+    if user is None:
+        return None
+    return await get_upcoming_deadlines(user, wait=True)
+
+
+# Background reminders, started in main() when REMINDER_OFFSETS is set
+reminders = ReminderScheduler(
+    bot,
+    fetch_user_deadlines,
+    offsets=REMINDER_OFFSETS,
+    refresh_interval=REMINDER_REFRESH_INTERVAL,
+    concurrency=REMINDER_CONCURRENCY,
+    rate=REMINDER_RATE,
+    senders=REMINDER_SENDERS,
+    on_blocked=db.delete_token,
+)
+
+
+# Scheduled per-group digests, started in main()
+digests = GroupDigests(
+    bot,
+    db,
+    fetch_user_deadlines,
+    page_entries=DEADLINES_PAGE_SIZE,
+    check_interval=GROUP_DIGEST_CHECK_INTERVAL,
+)
+
+
+# Groups already stored by this process
+known_groups = set()
+
+
+def forget_blocked_chat(kind, chat_id):
+    if kind == 'private':
+        reminders.remove_user(chat_id)
+    else:
+        known_groups.discard(chat_id)
+
+
+# Admin broadcasts, resumed in main() after a restart
+broadcaster = Broadcaster(
+    bot,
+    db,
+    rate=BROADCAST_RATE,
+    senders=BROADCAST_SENDERS,
+    on_blocked=forget_blocked_chat,
+    on_delivery=lambda kind, status: broadcast_messages.inc(kind, status),
+)
+
+
+MOODLE_DOWN_MESSAGE = "Moodle is not responding right now, please try again later."
+
+
+async def show_deadlines(chat_id, user):
+    try:
+        deadlines = await get_upcoming_deadlines(user)
+    except InvalidTokenError:
+        await bot.send_message(chat_id, "Invalid token. Please provide a valid token.")
+        return
+    except MoodleUnavailableError:
+        await bot.send_message(chat_id, MOODLE_DOWN_MESSAGE)
+        return
+
+    if deadlines is None:
+        await bot.send_message(chat_id, "No courses found.")
+        return
+
+    if not moodle.available:
+        await bot.send_message(chat_id, "⚠️ Moodle is slow, showing cached data.")
+    await send_deadline_view(chat_id, DeadlineView(deadlines, page_entries=DEADLINES_PAGE_SIZE))
+
+
+async def send_deadline_view(chat_id, view):
+    if not view.pages:
+        await bot.send_message(chat_id, "No upcoming deadlines.")
         return
 
-    upcoming_assignments = {}
+    view_id = deadline_views.add(chat_id, view)
     current_timestamp = int(datetime.now().timestamp())
-    tasks = [get_assignments(token, course['id']) for course in courses]
-    assignments = await asyncio.gather(*tasks)
-    
-    # Collecting deadlines
-    for course, assignment_list in zip(courses, assignments):
-        course_name = course['fullname']
-        for course_assignment in assignment_list.get('courses', []):
-            for assignment in course_assignment.get('assignments', []):
-                due_date = assignment['duedate']
-                assignment_name = assignment['name'].lower()
-
-                days_left = (due_date - current_timestamp) // (24 * 3600)
-                
-                if due_date >= current_timestamp and not any(term in assignment_name for term in ['midterm', 'endterm']):
-                    #time_left = time_remaining(due_date)
-                    if course_name not in upcoming_assignments:
-                        upcoming_assignments[course_name] = [] 
-
-                    if due_date >= current_timestamp:
-
-                        due_date = datetime.fromtimestamp(due_date) + timedelta(hours=2)
-                        current_time = datetime.fromtimestamp(current_timestamp)
-                        
-                        time_left = due_date - current_time
-                        days_left = time_left.days
-                        hours_left, remainder = divmod(time_left.seconds, 3600)
-                        minutes_left, seconds_left = divmod(remainder, 60)
-
-
-                    upcoming_assignments[course_name].append({
-                        'name': assignment['name'],
-                        'due_date': due_date,
-                        'days_left': days_left,
-                        'hours_left': hours_left,
-                        'minutes_left': minutes_left,
-                    })  
-
-    message_text = ''
-    message_parts = []  
-    assignment_index = 1
-
-    for course, assignments in upcoming_assignments.items():
-        for assignment in assignments:
-            message_text += "\n"
-            due_date_str = assignment['due_date'].strftime('%d %B %H:%M:%S')
-
-            if assignment['days_left'] < 1:
-                time_left = f"{assignment['hours_left']} hours, {assignment['minutes_left']:02d} minutes left"
-            else:
-                time_left = f"{assignment['days_left']} days left"
+    await bot.send_message(
+        chat_id,
+        view.render(0, current_timestamp) or "No upcoming deadlines.",
+        reply_markup=get_deadlines_keyboard(view_id, 0, len(view.pages))
+    )
 
 
-            message_parts.append(
-                (f"{assignment_index}. {due_date_str} ({time_left})\n"
-                             f"📝 {assignment['name']} is due - {course}\n")
-                )
-            assignment_index += 1
+def get_deadlines_keyboard(view_id, page, pages):
+    if pages < 2:
+        return None
+
+    buttons = [[
+        types.InlineKeyboardButton(text="◀️", callback_data=f"deadlines_{view_id}_{(page - 1) % pages}"),
+        types.InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="deadlines_noop"),
+        types.InlineKeyboardButton(text="▶️", callback_data=f"deadlines_{view_id}_{(page + 1) % pages}"),
+    ]]
+    return types.InlineKeyboardMarkup(inline_keyboard=buttons)
 
-    message_text = "\n".join(message_parts)
-    await bot.send_message(message, message_text if message_text else "No upcoming deadlines.")
+
+@router.callback_query(F.data.startswith("deadlines_"))
+async def deadlines_page(callback: types.CallbackQuery):
+    if callback.data == "deadlines_noop":
+        await callback.answer()
+        return
+
+    _, view_id, page = callback.data.split("_")
+    view = deadline_views.get(callback.message.chat.id, view_id)
+    if view is None:
+        await callback.answer("This list has expired, please request the deadlines again.")
+        return
+
+    page = int(page)
+    current_timestamp = int(datetime.now().timestamp())
+    await bot.edit_message_text(
+        text=view.render(page, current_timestamp) or "No upcoming deadlines on this page.",
+        chat_id=callback.message.chat.id,
+        message_id=callback.message.message_id,
+        reply_markup=get_deadlines_keyboard(view_id, page, len(view.pages))
+    )
+    await callback.answer()
+
+
+# Inline results built from the assignment store, per Telegram user
+inline_deadlines = InlineDeadlines(ttl=INLINE_CACHE_TIME, max_size=DEADLINE_CACHE_SIZE)
+
+
+@router.inline_query()
+async def inline_deadlines_query(inline_query: types.InlineQuery):
+    user_id = inline_query.from_user.id
+    articles = inline_deadlines.get(user_id)
+    if articles is None:
+        user = await db.get_user(user_id)
+        if user is None:
+            await inline_query.answer(
+                [],
+                is_personal=True,
+                cache_time=10,
+                button=types.InlineQueryResultsButton(text="Register in the bot to share deadlines", start_parameter="inline"),
+            )
+            return
+
+        try:
+            deadlines = await get_upcoming_deadlines(user)
+        except (InvalidTokenError, MoodleUnavailableError):
+            await inline_query.answer([], is_personal=True, cache_time=10)
+            return
+        articles = DeadlineArticles(deadlines or [])
+        inline_deadlines.add(user_id, articles)
+
+    offset = int(inline_query.offset or 0)
+    results = articles.search(inline_query.query, int(datetime.now().timestamp()))
+    next_offset = offset + INLINE_PAGE_SIZE
+    await inline_query.answer(
+        results[offset:next_offset],
+        is_personal=True,
+        cache_time=INLINE_CACHE_TIME,
+        next_offset=str(next_offset) if len(results) > next_offset else "",
+    )
+
+
+@router.message.outer_middleware()
+async def register_group_chat(handler, event: Message, data):
+    if event.chat.type in ['group', 'supergroup'] and event.chat.id not in known_groups:
+        known_groups.add(event.chat.id)
+        await db.store_group_chat_id(event.chat.id)
+    return await handler(event, data)
+
+
+@router.my_chat_member()
+async def bot_membership_changed(update: types.ChatMemberUpdated):
+    if update.chat.type not in ['group', 'supergroup']:
+        return
+
+    if update.new_chat_member.status in ['left', 'kicked']:
+        known_groups.discard(update.chat.id)
+        await db.delete_group_chat_id(update.chat.id)
+    else:
+        known_groups.add(update.chat.id)
+        await db.store_group_chat_id(update.chat.id)
 
 
 @router.message(Command("start")) 
 async def send_welcome(message: Message, state: FSMContext):
     chat_id = message.chat.id
 
-    if await is_user_registered(chat_id):
+    if await db.is_user_registered(chat_id):
         await main_menu(message)
     else:
         
@@ -305,7 +598,7 @@ async def send_welcome(message: Message, state: FSMContext):
         await state.update_data(welcome_message_id=sent_message.message_id)
         
 
-    token = await get_token(message.from_user.id)
+    token = await db.get_token(message.from_user.id)
 
     if not token :
         await state.set_state(UserState.waiting_for_token)
@@ -313,15 +606,24 @@ async def send_welcome(message: Message, state: FSMContext):
 
 
 @router.message(UserState.waiting_for_token)
-async def handle_message(message: Message, state: FSMContext):
+async def handle_token(message: Message, state: FSMContext):
     chat_id = message.chat.id
     message_id = message.message_id
     text = message.text
 
-    if await verify_security_key(text):
+    try:
+        site_info = await moodle.get_site_info(text)
+    except MoodleError:
+        site_info = None
+    except MoodleUnavailableError:
+        await message.answer(MOODLE_DOWN_MESSAGE)
+        return
+
+    if site_info and site_info.get('userid'):
         user = message.from_user
         first_name = user.first_name or "unknown"
-        await store_token(chat_id, first_name, text)
+        await db.store_token(chat_id, first_name, text, site_info['userid'], site_info.get('timezone'))
+        reminders.add_user(chat_id)
 
 
         data = await state.get_data()
@@ -343,38 +645,107 @@ async def handle_message(message: Message, state: FSMContext):
 
 
 @router.message(Command("deadlines"))
-async def handle_message(message: Message):
+@flags.expensive
+async def group_deadlines(message: Message):
     chat_id = message.chat.id
     text = message.text
 
     if message.chat.type in ['group', 'supergroup']: 
-            user_token = await get_token(message.from_user.id)
-            if user_token:
-                await show_deadlines(chat_id, user_token)
+            try:
+                view = await digests.get_view(chat_id)
+            except InvalidTokenError:
+                await message.answer("The token linked to this group's digest is no longer valid, please set it up again with /digest on.")
+                return
+            except MoodleUnavailableError:
+                await message.answer(MOODLE_DOWN_MESSAGE)
+                return
+            if view is not None:
+                await send_deadline_view(chat_id, view)
+                return
+
+            user = await db.get_user(message.from_user.id)
+            if user:
+                await show_deadlines(chat_id, user)
             else:
                 await message.answer(f'Please register with your "Moodle Mobile Web Service" token in the bot first.')
     
 
-@router.message(lambda message: message.text == "Deadlines")
+# Only the member whose deadlines a digest shows, or a group admin, may
+# change or turn off an existing digest
+async def can_manage_digest(message, digest):
+    if message.from_user.id == digest['digest_user_id']:
+        return True
+    member = await bot.get_chat_member(message.chat.id, message.from_user.id)
+    return member.status in ['creator', 'administrator']
+
+
+@router.message(Command("digest"))
+async def group_digest(message: Message, command: CommandObject):
+    chat_id = message.chat.id
+    if message.chat.type not in ['group', 'supergroup']:
+        await message.answer("Digests are available in group chats only.")
+        return
+
+    args = (command.args or "").split()
+    digest = await db.get_group_digest(chat_id)
+    if args[:1] == ["off"]:
+        if digest is None:
+            await message.answer("This group has no digest.")
+            return
+        if not await can_manage_digest(message, digest):
+            await message.answer("Only the linked member or a group admin can turn the digest off.")
+            return
+        await digests.disable(chat_id)
+        await message.answer("Deadlines digest is turned off.")
+        return
+
+    if args[:1] not in [[], ["on"]]:
+        await message.answer("Usage: /digest on [hours] or /digest off")
+        return
+
+    user = await db.get_user(message.from_user.id)
+    if not user:
+        await message.answer('Please register with your "Moodle Mobile Web Service" token in the bot first.')
+        return
+
+    if digest is not None and not await can_manage_digest(message, digest):
+        await message.answer("This group already has a digest. Only the linked member or a group admin can change it.")
+        return
+
+    try:
+        hours = float(args[1]) if len(args) > 1 else GROUP_DIGEST_INTERVAL
+    except ValueError:
+        hours = 0
+    if not 1 <= hours <= 168:
+        await message.answer("The interval must be between 1 and 168 hours.")
+        return
+
+    await digests.enable(chat_id, user['chat_id'], int(hours * 3600))
+    await message.answer(
+        f"Deadlines digest is on: {user['first_name']}'s deadlines will be posted here every {hours:g} hours, "
+        f"and /deadlines will show them to everyone."
+    )
+
+
+# Menu buttons, dispatched with one dict lookup (see menu.py)
+text_commands = TextCommands()
+text_commands.register(router.message)
+
+
+@text_commands("Deadlines", "Дедлайны")
+@flags.expensive
 async def handle_deadlines(message: Message, state: FSMContext):
-    token = await get_token(message.from_user.id)
-    user_data = await state.get_data()
+    user = await db.get_user(message.from_user.id)
     chat_id = message.chat.id
 
-    if user_data.get("is_processing"):
-        return    
-    if token:
-        user_id = await verify_security_key(token)
-        if user_id:
-            await show_deadlines(chat_id, token)
-        else:
-            await message.answer("Invalid token. Please provide a valid token.")
+    if user:
+        await show_deadlines(chat_id, user)
     else:
         await message.answer('Please provide a token first!')
         await state.set_state(UserState.waiting_for_token)
 
 
-@router.message(F.text == "Calculator")
+@text_commands("Calculator", "Калькулятор")
 async def calculator_menu(message: Message):
 
     info_message = (
@@ -396,20 +767,170 @@ async def calculator_menu(message: Message):
     await message.answer(info_message, reply_markup=builder.as_markup(resize_keyboard=True))
 
 
-@router.message(lambda message: message.text == "Scholarship")
+@text_commands("Scholarship", "Стипендия")
 async def scholarship_calculator(message: Message, state: FSMContext):
-    await bot.send_message(message.chat.id, "ℹ️Введите оценку за Register Mid-Term:")
-    
+    if await db.is_user_registered(message.from_user.id):
+        await message.answer("ℹ️Откуда взять оценки?", reply_markup=get_scholarship_keyboard())
+        return
+
+    await start_manual_scholarship(message.chat.id, state)
+
+
+def get_scholarship_keyboard():
+    buttons = [[
+        types.InlineKeyboardButton(text="📥 Из Moodle", callback_data="scholarship_moodle"),
+        types.InlineKeyboardButton(text="✍️ Ввести вручную", callback_data="scholarship_manual"),
+    ]]
+    return types.InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+async def start_manual_scholarship(chat_id, state):
+    await bot.send_message(chat_id, "ℹ️Введите оценку за Register Mid-Term:")
     await state.set_state(ScholarshipStates.waiting_for_first_attestation)
 
 
-@router.message(lambda message: message.text == "GPA")
-async def scholarship_calculator(message: Message, state: FSMContext):
-    await message.answer("Will be added soon!")
+@router.callback_query(F.data.startswith("scholarship_"))
+@flags.expensive
+async def scholarship_source(callback: types.CallbackQuery, state: FSMContext):
+    chat_id = callback.message.chat.id
+    await callback.answer()
+    await bot.delete_message(chat_id, callback.message.message_id)
+
+    if callback.data == "scholarship_manual":
+        await start_manual_scholarship(chat_id, state)
+        return
+
+    user = await db.get_user(callback.from_user.id)
+    if user is None:
+        await bot.send_message(chat_id, 'Please provide a token first!')
+        return
+    await show_scholarship_table(chat_id, user)
 
 
-@router.message(lambda message: message.text == "Exit")
-async def scholarship_calculator(message: Message):
+# Required Final Exam grades for every course, computed from the
+# register grades in the user's Moodle gradebook
+async def show_scholarship_table(chat_id, user):
+    try:
+        course_grades = await get_course_grades(user)
+    except InvalidTokenError:
+        await bot.send_message(chat_id, "Invalid token. Please provide a valid token.")
+        return
+    except MoodleUnavailableError:
+        await bot.send_message(chat_id, MOODLE_DOWN_MESSAGE)
+        return
+
+    if course_grades is None:
+        await bot.send_message(chat_id, "No courses found.")
+        return
+
+    rows = batch_thresholds([(course['fullname'], *register_grades(items)) for course, items in course_grades])
+    await bot.send_message(
+        chat_id,
+        format_scholarship_table(rows) + "\n" + html.escape(
+            "Нужный % на Final Exam: >50 — без RETAKE/FX, >70 — стипендия, >90 — повышенная стипендия. "
+            "✗ — недостижимо."
+        ),
+        parse_mode='HTML'
+    )
+
+
+@text_commands("GPA")
+@flags.expensive
+async def gpa_calculator(message: Message):
+    await show_gpa(message.chat.id, message.from_user.id)
+
+
+def get_gpa_keyboard():
+    buttons = [[
+        types.InlineKeyboardButton(text="➕ Добавить курс", callback_data="gpa_add"),
+        types.InlineKeyboardButton(text="🗑 Очистить добавленные", callback_data="gpa_clear"),
+    ]]
+    return types.InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+# GPA over the user's Moodle courses plus the courses added by hand
+async def show_gpa(chat_id, user_chat_id):
+    grades = []
+    user = await db.get_user(user_chat_id)
+    if user:
+        try:
+            grades = await get_gpa_grades(user)
+        except InvalidTokenError:
+            await bot.send_message(chat_id, "Invalid token. Please provide a valid token.")
+            return
+        except MoodleUnavailableError:
+            await bot.send_message(chat_id, MOODLE_DOWN_MESSAGE)
+            return
+
+    grades += [course_grade(course['name'], course['percentage'], course['credits'])
+               for course in await db.get_manual_courses(user_chat_id)]
+    value = gpa(grades)
+    if not grades:
+        text = "ℹ️Оценок пока нет. Добавьте курсы вручную, чтобы посчитать GPA."
+    else:
+        text = format_gpa_table(grades) + "\n" + (
+            f"<b>GPA: {value:.2f}</b>" if value is not None else "GPA: нет выставленных оценок"
+        )
+    await bot.send_message(chat_id, text, parse_mode='HTML', reply_markup=get_gpa_keyboard())
+
+
+@router.callback_query(F.data.startswith("gpa_"))
+@flags.expensive
+async def gpa_actions(callback: types.CallbackQuery, state: FSMContext):
+    chat_id = callback.message.chat.id
+    await callback.answer()
+
+    if callback.data == "gpa_clear":
+        await db.clear_manual_courses(callback.from_user.id)
+        await show_gpa(chat_id, callback.from_user.id)
+    else:
+        await bot.send_message(chat_id, "ℹ️Введите название курса:")
+        await state.set_state(GpaStates.waiting_for_course_name)
+
+
+@router.message(GpaStates.waiting_for_course_name)
+async def get_gpa_course_name(message: Message, state: FSMContext):
+    if not message.text:
+        await message.answer("Пожалуйста, отправьте название курса текстом.")
+        return
+    await state.update_data(gpa_course_name=message.text.strip()[:64])
+    await message.answer("ℹ️Введите количество кредитов:")
+    await state.set_state(GpaStates.waiting_for_credits)
+
+
+@router.message(GpaStates.waiting_for_credits)
+async def get_gpa_credits(message: Message, state: FSMContext):
+    try:
+        credits = float((message.text or "").replace(',', '.'))
+    except ValueError:
+        credits = 0
+    if not 1 <= credits <= 30:
+        await message.answer("Пожалуйста введите количество кредитов от 1 до 30.")
+        return
+    await state.update_data(gpa_credits=credits)
+    await message.answer("ℹ️Введите итоговую оценку за курс (0-100):")
+    await state.set_state(GpaStates.waiting_for_grade)
+
+
+@router.message(GpaStates.waiting_for_grade)
+async def get_gpa_grade(message: Message, state: FSMContext):
+    try:
+        percentage = float((message.text or "").replace(',', '.'))
+    except ValueError:
+        percentage = -1
+    if not 0 <= percentage <= 100:
+        await message.answer("Пожалуйста введите допустимую оценку от 0 до 100.")
+        return
+
+    data = await state.get_data()
+    await db.add_manual_course(message.from_user.id, data['gpa_course_name'], data['gpa_credits'], percentage)
+    await state.clear()
+    await show_gpa(message.chat.id, message.from_user.id)
+
+
+@text_commands("Exit", "Выход")
+async def exit_to_main_menu(message: Message, state: FSMContext):
+    await state.clear()
     await main_menu(message)
 
 
@@ -457,12 +978,11 @@ async def get_second_attestation(message: Message, state: FSMContext):
         await bot.send_message(message.chat.id, "Неверный ввод. Пожалуйста, введите действительную оценку за Register End-Term.")
 
 async def calculate_scholarship(first_att: float, second_att: float, message: Message):
-    current_grade = 0.3 * first_att + 0.3 * second_att
-
-    required_for_retake = max(50, (50 - current_grade) / 0.4)
-    required_for_scholarship = max(50, (70 - current_grade) / 0.4)
-    required_for_high_scholarship = max(0, (90 - current_grade) / 0.4)
-    grade_if_100_final = current_grade + 0.4 * 100
+    thresholds = scholarship_thresholds(first_att, second_att)
+    required_for_retake = thresholds['retake']
+    required_for_scholarship = thresholds['scholarship']
+    required_for_high_scholarship = thresholds['high_scholarship']
+    grade_if_100_final = thresholds['if_100_final']
 
     high_scholarship_message = f"{int(required_for_high_scholarship)}%" if required_for_high_scholarship <= 100 else "Невозможно"
     not_retake = int(required_for_retake)
@@ -498,7 +1018,13 @@ async def callbacks_num(callback: types.CallbackQuery):
     message_id = callback.message.message_id
 
     if action == "delete":
-        await delete_token(chat_id)
+        token = await db.get_token(chat_id)
+        if token:
+            deadline_cache.invalidate(token)
+            gpa_engine.forget(token)
+        inline_deadlines.invalidate(chat_id)
+        await db.delete_token(chat_id)
+        reminders.remove_user(chat_id)
         await bot.edit_message_text(
             text='Your token is deleted!', 
             chat_id=chat_id,  
@@ -513,10 +1039,10 @@ async def callbacks_num(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@router.message(lambda message: message.text == "👤Profile")
+@text_commands("👤Profile", "Profile")
 async def profile_options(message, state: FSMContext):
         chat_id = message.chat.id
-        token = await get_token(chat_id)
+        token = await db.get_token(chat_id)
 
         if not token :
             await bot.send_message(chat_id , 'Provide your token first!')
@@ -528,7 +1054,7 @@ async def profile_options(message, state: FSMContext):
 
 
 async def send_broadcast_for_group(message):
-    all_ids = await get_all_group_chat_ids() 
+    all_ids = await db.get_all_group_chat_ids() 
     message_text = message.text
 
     if message_text.lower() == "exit":
@@ -537,19 +1063,15 @@ async def send_broadcast_for_group(message):
         return
 
 
-    for chat_id in all_ids:
-        try:    
-            await bot.send_message(chat_id, message_text) 
-        except Exception as e:
-            print(f"Failed to send message to {chat_id}: {e}")
-    
-    await message.answer("Broadcast message sent successfully!")
+    job_id = await broadcaster.start('group', message_text, message.chat.id)
+
+    await message.answer(f"Broadcast #{job_id} started for {len(all_ids)} group chats.")
     await broadcast_btn(message)
 
 
 
 async def send_broadcast_for_private_chats(message):
-    all_ids = await get_users_id()
+    all_ids = await db.get_users_id()
     message_text = message.text
 
     if message_text.lower() == "exit":
@@ -557,13 +1079,9 @@ async def send_broadcast_for_private_chats(message):
         await main_menu(message)
         return
 
-    for chat_id in all_ids:
-        try:
-            await bot.send_message(chat_id, message_text)
-        except Exception as e :
-            await message.answer(message.chat.id , f"Failed to send a message to {chat_id}: {e}")
+    job_id = await broadcaster.start('private', message_text, message.chat.id)
 
-    await message.answer("Broadcast message sent successfully!")
+    await message.answer(f"Broadcast #{job_id} started for {len(all_ids)} users.")
     await broadcast_btn(message)
 
 
@@ -584,7 +1102,7 @@ async def process_private_chat_message(message):
         await send_broadcast_for_private_chats(message)
 
 
-@router.message(lambda message : message.text == "🔑Admin")
+@text_commands("🔑Admin", "Admin")
 async def admin_panel(message: Message):
     if message.from_user.id == ADMIN_ID:
         await message.answer("Assalamu aleykum boss!")
@@ -595,27 +1113,87 @@ async def admin_panel(message: Message):
 
 
 
-@router.message(lambda message: message.text == "Users")
+def get_export_keyboard():
+    buttons = [
+        [types.InlineKeyboardButton(text="💾 Database backup", callback_data="export_db")],
+        [
+            types.InlineKeyboardButton(text="CSV (.gz)", callback_data="export_csv"),
+            types.InlineKeyboardButton(text="JSON (.gz)", callback_data="export_json"),
+        ],
+    ]
+    return types.InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@text_commands("Users")
 async def send_users_data(message):
-    chat_id = message.chat.id
-    file_path = 'users.db'
-    
-    if os.path.exists(file_path):
-        with open(file_path, 'rb') as file:
-            file = FSInputFile(file_path)
-            await bot.send_document(chat_id, file)
-    else:
-        await message.answer('Users data not found!')
+    if message.from_user.id != ADMIN_ID:
+        return
+    await message.answer(
+        "Choose an export. The backup is a full copy of the database, tokens included; "
+        "CSV and JSON list users and groups without tokens.",
+        reply_markup=get_export_keyboard()
+    )
+
+
+@router.callback_query(F.data.startswith("export_"))
+async def export_users_data(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer()
+        return
+
+    kind = callback.data.split("_")[1]
+    await callback.answer("Preparing the export...")
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    directory = await asyncio.to_thread(tempfile.mkdtemp)
+    try:
+        if kind == "db":
+            file_path = os.path.join(directory, f"users-{stamp}.db")
+            await db.backup(file_path)
+        else:
+            file_path = os.path.join(directory, f"users-{stamp}.{kind}.gz")
+            await db.export_chats(file_path, kind)
+        await bot.send_document(callback.message.chat.id, FSInputFile(file_path))
+    except Exception as e:
+        logging.error(f"Export failed: {e}")
+        await bot.send_message(callback.message.chat.id, "Export failed, see the logs.")
+    finally:
+        await asyncio.to_thread(shutil.rmtree, directory, True)
+
 
 
+def format_quantiles(histogram):
+    if not histogram.count():
+        return "no data"
+    return f"p50 ≤ {histogram.quantile(0.5)}s, p99 ≤ {histogram.quantile(0.99)}s"
 
-@router.message(lambda message: message.text == "Broadcast")
+
+@text_commands("Stats")
+async def send_stats(message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    chats = await db.count_chats()
+    states = await fsm_storage.count_states()
+    uptime = int(time.time() - metrics.started)
+    await message.answer(
+        f"📊 Stats (this process, up {uptime // 3600}h {uptime % 3600 // 60}m)\n"
+        f"Users: {chats['private']}, groups: {chats['group']}\n"
+        f"Handlers: {handler_latency.count()} calls, {handler_errors.total()} errors, {format_quantiles(handler_latency)}\n"
+        f"Moodle: {moodle_latency.count()} calls, {moodle_errors.total()} errors, {format_quantiles(moodle_latency)}"
+        f"{'' if moodle.available else ', circuit open'}\n"
+        f"Database: {db_latency.count()} queries, {format_quantiles(db_latency)}\n"
+        f"Broadcasts: {broadcast_messages.total()} processed\n"
+        f"Conversations: {sum(states.values())} ({', '.join(f'{state}: {count}' for state, count in states.items()) or 'none'})"
+    )
+
+
+@text_commands("Broadcast")
 async def brd_menu(message):
     await broadcast_btn(message)
 
 
 
-@router.message(lambda message: message.text == "Induvidual chats")
+@text_commands("Induvidual chats", "Individual chats")
 async def private_chat(message: types.Message, state: FSMContext):
     builder = ReplyKeyboardBuilder()
     builder.row(KeyboardButton(text="Exit"))
@@ -637,7 +1215,7 @@ async def handle_broadcast_message(message: types.Message, state: FSMContext):
     
 
 
-@router.message(lambda message: message.text == "Group chats")
+@text_commands("Group chats")
 async def group_chat(message: types.Message, state: FSMContext):
     builder = ReplyKeyboardBuilder()
     builder.row(KeyboardButton(text="Exit"))
@@ -655,10 +1233,117 @@ async def handle_group_broadcast_message(message: types.Message, state: FSMConte
 
 
 
-async def main():
+# Open per-process resources. owns_chat restricts background jobs
+# (reminders, resumed broadcasts) to the chats this process serves.
+async def startup(owns_chat=None, metrics_port=METRICS_PORT):
+    global moodle, metrics_runner
+    moodle = MoodleClient(
+        MOODLE_URL,
+        limit=MOODLE_POOL_SIZE,
+        limit_per_host=MOODLE_POOL_PER_HOST,
+        dns_ttl=MOODLE_DNS_TTL,
+        keepalive_timeout=MOODLE_KEEPALIVE,
+        total_timeout=MOODLE_TIMEOUT,
+        connect_timeout=MOODLE_CONNECT_TIMEOUT,
+        read_timeout=MOODLE_READ_TIMEOUT,
+        max_retries=MOODLE_MAX_RETRIES,
+        breaker=CircuitBreaker(MOODLE_BREAKER_THRESHOLD, MOODLE_BREAKER_RESET),
+        assign_chunk_size=MOODLE_ASSIGN_CHUNK,
+        per_token_limit=MOODLE_PER_TOKEN_LIMIT,
+        on_call=record_moodle_call,
+    )
+    await moodle.start()
+
     await create_db()
+    if REMINDER_OFFSETS:
+        await reminders.start([chat_id for chat_id in await db.get_users_id()
+                               if owns_chat is None or owns_chat(chat_id)])
+    await broadcaster.resume(owns_chat)
+    await digests.start(owns_chat)
+    if metrics_port:
+        metrics_runner = await start_metrics_server(metrics, METRICS_HOST, metrics_port)
+
+    dp.include_router(router)
+
+
+async def shutdown():
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await digests.stop()
+    await broadcaster.stop()
+    await reminders.stop()
+    await moodle.close()
+    await db.close()
+
+
+# Entry point of a worker process in multi-process mode
+def run_worker(index, workers, queue):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_worker(index, workers, queue))
+
+
+async def serve_worker(index, workers, queue):
+    ring = HashRing(range(workers))
+    await startup(
+        owns_chat=lambda chat_id: ring.node_for(chat_id) == index,
+        metrics_port=METRICS_PORT + index if METRICS_PORT else 0,
+    )
+    await dp.emit_startup(bot=bot)
+    try:
+        await serve_updates(queue, lambda update: dp.feed_raw_update(bot, update))
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await shutdown()
+        await bot.session.close()
+
+
+async def run_supervisor():
+    supervisor = Supervisor(run_worker, WORKERS)
     dp.include_router(router)
-    await dp.start_polling(bot)
+    allowed_updates = dp.resolve_used_update_types()
+
+    try:
+        if BOT_MODE == 'webhook':
+            await supervisor.run(supervisor.serve_webhook(
+                bot,
+                WEBHOOK_URL,
+                path=WEBHOOK_PATH,
+                host=WEBHOOK_HOST,
+                port=WEBHOOK_PORT,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=allowed_updates,
+            ))
+        else:
+            await bot.delete_webhook()
+            await supervisor.run(supervisor.poll(bot, allowed_updates))
+    finally:
+        await bot.session.close()
+
+
+async def main():
+    if WORKERS > 1:
+        await run_supervisor()
+        return
+
+    await startup()
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook(
+                dp,
+                bot,
+                WEBHOOK_URL,
+                path=WEBHOOK_PATH,
+                host=WEBHOOK_HOST,
+                port=WEBHOOK_PORT,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                drain_timeout=WEBHOOK_DRAIN_TIMEOUT,
+            )
+        else:
+            await dp.start_polling(bot)
+    finally:
+        await shutdown()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
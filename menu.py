@@ -0,0 +1,46 @@
+from aiogram.dispatcher.event.handler import CallableObject
+
+
+def normalize(text):
+    return text.strip().casefold()
+
+
+# Routing table for menu buttons and other fixed texts.
+#
+# Instead of one lambda filter per button, which aiogram tries one after
+# another for every message, a single handler is registered on the router
+# and the button text is looked up in a dict. The matching callback is
+# passed to that handler as `text_command`. Registering a text twice
+# raises at import, so two buttons can never silently shadow each other.
+class TextCommands:
+    def __init__(self):
+        self._commands = {}
+
+    def __call__(self, text, *aliases):
+        def decorator(callback):
+            self.add(callback, text, *aliases)
+            return callback
+        return decorator
+
+    def add(self, callback, text, *aliases):
+        command = CallableObject(callback)
+        for key in map(normalize, (text, *aliases)):
+            existing = self._commands.get(key)
+            if existing is not None:
+                raise ValueError(f"Text {key!r} of {callback.__name__} is already "
+                                 f"handled by {existing.callback.__name__}")
+            self._commands[key] = command
+
+    def register(self, observer):
+        observer.register(self.dispatch, self.filter)
+
+    def filter(self, message):
+        if not message.text:
+            return False
+        command = self._commands.get(normalize(message.text))
+        return {'text_command': command} if command is not None else False
+
+    @staticmethod
+    async def dispatch(message, text_command, **kwargs):
+        # CallableObject only passes the arguments the callback accepts
+        return await text_command.call(message, **kwargs)
@@ -0,0 +1,174 @@
+import bisect
+import logging
+import time
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def total(self):
+        return sum(self._values.values())
+
+    def samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield self.name + _format_labels(self.labelnames, labels), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (+Inf last), sum]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def count(self):
+        return sum(sum(counts) for counts, _ in self._values.values())
+
+    # Upper bound of the bucket holding the q-th quantile, over all labels
+    def quantile(self, q):
+        counts = [0] * (len(self.buckets) + 1)
+        for bucket_counts, _ in self._values.values():
+            counts = [a + b for a, b in zip(counts, bucket_counts)]
+        total = sum(counts)
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield self.name + '_bucket' + _format_labels(self.labelnames, labels, [('le', bound)]), cumulative
+            yield self.name + '_sum' + _format_labels(self.labelnames, labels), total
+            yield self.name + '_count' + _format_labels(self.labelnames, labels), cumulative
+
+
+# Value read when the metrics are scraped; `collect` is an async callable
+# returning {labels tuple: value}.
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, help, collect, labelnames=()):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.labelnames = labelnames
+        self._values = {}
+
+    async def refresh(self):
+        self._values = await self.collect()
+
+    def samples(self):
+        for labels, value in sorted(self._values.items(), key=lambda item: tuple(map(str, item[0]))):
+            yield self.name + _format_labels(self.labelnames, labels), value
+
+
+class Registry:
+    def __init__(self):
+        self.started = time.time()
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, collect, labelnames=()):
+        return self.register(Gauge(name, help, collect, labelnames))
+
+    async def refresh(self):
+        for metric in self._metrics:
+            if isinstance(metric, Gauge):
+                try:
+                    await metric.refresh()
+                except Exception as e:
+                    logging.error(f"Failed to collect {metric.name}: {e}")
+
+    # Prometheus text exposition format
+    async def render(self):
+        await self.refresh()
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(f'{name} {value}' for name, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+# Records the latency and failures of every handler of the observer it
+# is attached to, labelled with the handler's function name.
+class HandlerMetricsMiddleware(BaseMiddleware):
+    def __init__(self, latency, errors):
+        self.latency = latency
+        self.errors = errors
+
+    async def __call__(self, handler, event, data):
+        # Menu buttons share one router handler, label them by their own callback
+        command = data.get('text_command')
+        name = (command or data['handler']).callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors.inc(name)
+            raise
+        finally:
+            self.latency.observe(time.perf_counter() - started, name)
+
+
+async def start_metrics_server(registry, host='127.0.0.1', port=9100):
+    async def handle(request):
+        return web.Response(text=await registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics available on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,336 @@
+import aiohttp
+import asyncio
+import json
+import logging
+import random
+import time
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+# Moodle answered with an exception payload instead of data
+class MoodleError(Exception):
+    def __init__(self, errorcode, message):
+        super().__init__(message)
+        self.errorcode = errorcode
+
+
+class InvalidTokenError(MoodleError):
+    pass
+
+
+# Moodle could not be reached, timed out, answered with something that
+# is not a web-service response, or the circuit breaker is open
+class MoodleUnavailableError(Exception):
+    pass
+
+
+INVALID_TOKEN_CODES = {'invalidtoken', 'accessexception'}
+TRANSPORT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ValueError)
+
+
+# The part of an assignment the bot uses. mod_assign_get_assignments also
+# returns intro HTML, attachments and config arrays, which are dropped as
+# soon as a response is decoded.
+class Assignment:
+    __slots__ = ('id', 'course_id', 'name', 'duedate', 'timemodified')
+
+    def __init__(self, id, course_id, name, duedate, timemodified=0):
+        self.id = id
+        self.course_id = course_id
+        self.name = name
+        self.duedate = duedate
+        self.timemodified = timemodified
+
+
+# Retries are only allowed while they stay under `ratio` of all requests
+# (plus a small reserve), so an outage cannot multiply the load on Moodle.
+class RetryBudget:
+    def __init__(self, ratio=0.1, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self._balance = reserve
+
+    def record_request(self):
+        self._balance = min(self.reserve, self._balance + self.ratio)
+
+    def try_spend(self):
+        if self._balance < 1:
+            return False
+        self._balance -= 1
+        return True
+
+
+# Opens after `failure_threshold` failed calls in a row. While open every
+# call fails at once; after `reset_timeout` one probe call is let through
+# and its result closes the breaker or opens it again.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        if self._opened_at is None:
+            return True
+        if self._probing or time.monotonic() - self._opened_at < self.reset_timeout:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self):
+        if self._opened_at is not None:
+            logging.info("Moodle is responding again, closing the circuit breaker")
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self._opened_at is None:
+            if self._failures >= self.failure_threshold:
+                logging.warning(f"Moodle failed {self._failures} calls in a row, opening the circuit breaker")
+                self._opened_at = time.monotonic()
+        elif self._probing:
+            self._opened_at = time.monotonic()
+            self._probing = False
+
+
+# Long-lived Moodle web-service client.
+# One ClientSession (and one connection pool) is shared by every handler,
+# so repeated calls reuse keep-alive connections instead of paying a new
+# TCP/TLS handshake each time.
+#
+# Every request has its own connect and read timeouts. Transport failures
+# are retried with jittered backoff while the retry budget allows it and
+# then raise MoodleUnavailableError; a circuit breaker stops calling
+# Moodle for a while once it keeps failing. Errors reported by Moodle
+# itself (bad token, missing rights) are raised as MoodleError and never
+# retried.
+#
+# Identical calls made while one is already in flight (same wsfunction,
+# params and token) wait for that request instead of sending their own,
+# and at most `per_token_limit` requests per token run at once. Callers
+# share the decoded response, so they must not modify it.
+class MoodleClient:
+    def __init__(self, url, limit=100, limit_per_host=20, dns_ttl=300,
+                 keepalive_timeout=30, total_timeout=30, connect_timeout=10,
+                 read_timeout=10, assign_chunk_size=20, per_token_limit=4,
+                 max_retries=2, retry_backoff=0.5, retry_budget=None, breaker=None, on_call=None):
+        self.url = url
+        self.assign_chunk_size = assign_chunk_size
+        self.per_token_limit = per_token_limit
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout, sock_read=read_timeout)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.retry_budget = retry_budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker()
+        # on_call(wsfunction, seconds, error) after every request sent, with
+        # error None, 'invalid_token', 'moodle' or 'unavailable'
+        self.on_call = on_call
+        self._session = None
+        self._inflight = {}
+        self._token_limits = {}
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self._session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    # False while the circuit breaker is open
+    @property
+    def available(self):
+        return not self.breaker.is_open
+
+    async def call(self, token, wsfunction, **params):
+        key = (token, wsfunction, tuple(sorted(params.items())))
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._limited_request(token, wsfunction, params))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._finish(key))
+        # A cancelled caller must not cancel the request the others wait for
+        return await asyncio.shield(task)
+
+    def _finish(self, key):
+        task = self._inflight.pop(key)
+        if not task.cancelled():
+            # Mark the error as retrieved in case every caller gave up
+            task.exception()
+
+    async def _limited_request(self, token, wsfunction, params):
+        entry = self._token_limits.get(token)
+        if entry is None:
+            entry = self._token_limits[token] = [asyncio.Semaphore(self.per_token_limit), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await self._timed_request(token, wsfunction, params)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._token_limits[token]
+
+    async def _timed_request(self, token, wsfunction, params):
+        if self.on_call is None:
+            return await self._request(token, wsfunction, params)
+
+        started = time.perf_counter()
+        error = None
+        try:
+            return await self._request(token, wsfunction, params)
+        except InvalidTokenError:
+            error = 'invalid_token'
+            raise
+        except MoodleError:
+            error = 'moodle'
+            raise
+        except MoodleUnavailableError:
+            error = 'unavailable'
+            raise
+        finally:
+            self.on_call(wsfunction, time.perf_counter() - started, error)
+
+    async def _request(self, token, wsfunction, params):
+        params = dict(params)
+        params.update({
+            'wstoken': token,
+            'wsfunction': wsfunction,
+            'moodlewsrestformat': 'json'
+        })
+
+        self.retry_budget.record_request()
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise MoodleUnavailableError("Moodle is unavailable (circuit breaker open)")
+            try:
+                data = await self._fetch(params)
+            except TRANSPORT_ERRORS as e:
+                self.breaker.record_failure()
+                if attempt >= self.max_retries or self.breaker.is_open or not self.retry_budget.try_spend():
+                    raise MoodleUnavailableError(f"{wsfunction} failed: {e!r}") from e
+                attempt += 1
+                # Full jitter keeps retrying callers from hitting Moodle in lockstep
+                await asyncio.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+                continue
+            self.breaker.record_success()
+            break
+
+        if isinstance(data, dict) and 'exception' in data:
+            errorcode = data.get('errorcode')
+            error = InvalidTokenError if errorcode in INVALID_TOKEN_CODES else MoodleError
+            raise error(errorcode, data.get('message', errorcode))
+        return data
+
+    async def _fetch(self, params):
+        async with self._session.get(self.url, params=params, timeout=self.timeout) as response:
+            if response.status >= 500:
+                raise aiohttp.ClientResponseError(
+                    response.request_info, response.history, status=response.status, message=response.reason)
+            body = await response.read()
+        # Non-JSON answers (maintenance pages and the like) raise a ValueError
+        return json_loads(body)
+
+    # Site info for a token. Raises InvalidTokenError if Moodle rejects
+    # the token and MoodleUnavailableError if Moodle cannot be reached.
+    async def get_site_info(self, token):
+        return await self.call(token, 'core_webservice_get_site_info')
+
+    async def get_courses(self, token, user_id):
+        try:
+            return await self.call(token, 'core_enrol_get_users_courses', userid=user_id)
+        except InvalidTokenError:
+            raise
+        except MoodleError as e:
+            logging.error(f"Error retrieving courses: {e}")
+            return []
+
+    # Gradebook items of one course for one user, [] if Moodle refuses
+    async def get_grade_items(self, token, user_id, course_id):
+        try:
+            data = await self.call(token, 'gradereport_user_get_grade_items', courseid=course_id, userid=user_id)
+        except InvalidTokenError:
+            raise
+        except MoodleError as e:
+            logging.error(f"Error retrieving grades for course {course_id}: {e}")
+            return []
+        usergrades = data.get('usergrades') or [{}]
+        return usergrades[0].get('gradeitems', [])
+
+    # {course_id: final grade} for all of the user's courses in one call,
+    # None if Moodle refuses. Used to spot courses whose grades changed.
+    async def get_course_overview(self, token, user_id):
+        try:
+            data = await self.call(token, 'gradereport_overview_get_course_grades', userid=user_id)
+        except InvalidTokenError:
+            raise
+        except MoodleError as e:
+            logging.error(f"Error retrieving grade overview: {e}")
+            return None
+        return {grade['courseid']: grade.get('rawgrade', grade.get('grade')) for grade in data.get('grades', [])}
+
+    # Fetch assignments for many courses with as few requests as possible.
+    # Course ids are sent `assign_chunk_size` at a time as courseids[0..n]
+    # and the response is split back into {course_id: [Assignment, ...]}.
+    # Transport failures are raised rather than returned as empty courses,
+    # which would read as every assignment having been removed. Courses of
+    # a chunk that Moodle refused are left out of the result for the same
+    # reason.
+    async def get_assignments(self, token, course_ids):
+        chunks = [course_ids[i:i + self.assign_chunk_size]
+                  for i in range(0, len(course_ids), self.assign_chunk_size)]
+        responses = await asyncio.gather(*(self._get_assignment_chunk(token, chunk) for chunk in chunks))
+
+        assignments = {}
+        for chunk, response in zip(chunks, responses):
+            if response is None:
+                continue
+            for course_id in chunk:
+                assignments[course_id] = []
+            for course_id, course_assignments in response.items():
+                assignments.setdefault(course_id, []).extend(course_assignments)
+        return assignments
+
+    # None if Moodle refused the chunk
+    async def _get_assignment_chunk(self, token, course_ids):
+        params = {f'courseids[{i}]': course_id for i, course_id in enumerate(course_ids)}
+        try:
+            data = await self.call(token, 'mod_assign_get_assignments', **params)
+        except InvalidTokenError:
+            raise
+        except MoodleError as e:
+            logging.error(f"Error retrieving assignments: {e}")
+            return None
+        return {
+            course['id']: [
+                Assignment(assignment['id'], course['id'], assignment['name'],
+                           assignment['duedate'], assignment.get('timemodified', 0))
+                for assignment in course.get('assignments', [])
+            ]
+            for course in data.get('courses', [])
+        }
@@ -0,0 +1,192 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import zlib
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from broadcast import TokenBucket
+
+
+def format_offset(seconds):
+    hours = seconds // 3600
+    if hours >= 1:
+        return f"{hours} hour" if hours == 1 else f"{hours} hours"
+    return f"{seconds // 60} minutes"
+
+
+# Pushes "due soon" reminders to registered users.
+#
+# Two heaps drive everything, so a tick never scans the user list:
+#   _reminders - (fire_at, ...) for every pending reminder
+#   _refreshes - (refresh_at, chat_id, ...), one entry per user
+# Due refreshes are handed to a fixed pool of workers, which caps the
+# number of concurrent Moodle fetches. Each refresh gives the user a new
+# version; reminders from older versions are skipped when popped and
+# swept out once they outnumber the live ones.
+#
+# Due reminders go to a queue drained by `senders` tasks sharing one
+# token bucket of `rate` messages per second, since a cohort sharing due
+# dates gets its reminders in the same second. RetryAfter pauses the
+# bucket and the reminder is retried; users who blocked the bot are
+# dropped and passed to the awaited `on_blocked(chat_id)`.
+class ReminderScheduler:
+    def __init__(self, bot, fetch, offsets=(24 * 3600, 3 * 3600, 3600),
+                 refresh_interval=3600, startup_spread=600, concurrency=5,
+                 rate=10, senders=5, max_retries=3, on_blocked=None):
+        self.bot = bot
+        self.fetch = fetch
+        self.offsets = sorted(offsets, reverse=True)
+        self.refresh_interval = refresh_interval
+        self.startup_spread = min(startup_spread, refresh_interval)
+        self.concurrency = concurrency
+        self.senders = senders
+        self.max_retries = max_retries
+        self.on_blocked = on_blocked
+        self.limiter = TokenBucket(rate)
+
+        self._reminders = []
+        self._refreshes = []
+        self._registered = {}
+        self._versions = {}
+        self._live = {}
+        self._stale = 0
+        self._counter = itertools.count()
+        self._queue = asyncio.Queue()
+        self._outbox = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    async def start(self, chat_ids):
+        now = time.time()
+        for chat_id in chat_ids:
+            # Spread the first refresh of every user over startup_spread
+            # so a restart does not hit Moodle with every user at once.
+            delay = zlib.crc32(str(chat_id).encode()) % 1000 / 1000 * self.startup_spread
+            self._register(chat_id, now + delay)
+
+        self._tasks.append(asyncio.create_task(self._run()))
+        for _ in range(self.concurrency):
+            self._tasks.append(asyncio.create_task(self._worker()))
+        for _ in range(self.senders):
+            self._tasks.append(asyncio.create_task(self._sender()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def add_user(self, chat_id):
+        if chat_id not in self._registered:
+            self._register(chat_id, time.time())
+            self._wakeup.set()
+
+    def remove_user(self, chat_id):
+        if self._registered.pop(chat_id, None) is not None:
+            self._versions.pop(chat_id, None)
+            self._stale += self._live.pop(chat_id, 0)
+
+    def _register(self, chat_id, refresh_at):
+        registration = next(self._counter)
+        self._registered[chat_id] = registration
+        self._versions[chat_id] = registration
+        heapq.heappush(self._refreshes, (refresh_at, chat_id, registration))
+
+    async def _run(self):
+        while True:
+            now = time.time()
+
+            while self._reminders and self._reminders[0][0] <= now:
+                _, _, chat_id, version, offset, deadline = heapq.heappop(self._reminders)
+                if self._versions.get(chat_id) != version:
+                    self._stale -= 1
+                    continue
+                self._live[chat_id] -= 1
+                self._outbox.put_nowait((chat_id, offset, deadline))
+
+            while self._refreshes and self._refreshes[0][0] <= now:
+                _, chat_id, registration = heapq.heappop(self._refreshes)
+                if self._registered.get(chat_id) == registration:
+                    self._queue.put_nowait((chat_id, registration))
+
+            next_times = [heap[0][0] for heap in (self._reminders, self._refreshes) if heap]
+            timeout = max(0, min(next_times) - now) if next_times else None
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            chat_id, registration = await self._queue.get()
+            try:
+                await self._refresh(chat_id)
+            except Exception as e:
+                logging.error(f"Reminder refresh failed for {chat_id}: {e}")
+            finally:
+                if self._registered.get(chat_id) == registration:
+                    heapq.heappush(self._refreshes, (time.time() + self.refresh_interval, chat_id, registration))
+                    self._wakeup.set()
+
+    async def _refresh(self, chat_id):
+        deadlines = await self.fetch(chat_id)
+        if chat_id not in self._versions:
+            return
+
+        version = next(self._counter)
+        self._versions[chat_id] = version
+        self._stale += self._live.get(chat_id, 0)
+
+        now = time.time()
+        live = 0
+        for deadline in deadlines or []:
+            for offset in self.offsets:
+                fire_at = deadline['duedate'] - offset
+                if fire_at > now:
+                    heapq.heappush(self._reminders, (fire_at, next(self._counter), chat_id, version, offset, deadline))
+                    live += 1
+        self._live[chat_id] = live
+
+        if self._stale > len(self._reminders) // 2:
+            self._compact()
+        self._wakeup.set()
+
+    def _compact(self):
+        self._reminders = [entry for entry in self._reminders if self._versions.get(entry[2]) == entry[3]]
+        heapq.heapify(self._reminders)
+        self._stale = 0
+
+    async def _sender(self):
+        while True:
+            chat_id, offset, deadline = await self._outbox.get()
+            if chat_id in self._registered:
+                await self._send(chat_id, offset, deadline)
+
+    async def _send(self, chat_id, offset, deadline):
+        text = f"⏰ {deadline['name']} is due in {format_offset(offset)} - {deadline['course']}"
+        for _ in range(self.max_retries + 1):
+            await self.limiter.acquire()
+            try:
+                await self.bot.send_message(chat_id, text)
+                return
+            except TelegramRetryAfter as e:
+                logging.warning(f"Reminders rate limited, retrying in {e.retry_after}s")
+                self.limiter.pause(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                if isinstance(e, TelegramBadRequest) and 'chat not found' not in e.message.lower():
+                    logging.error(f"Failed to send reminder to {chat_id}: {e}")
+                    return
+                logging.info(f"{chat_id} blocked the bot, dropping their reminders")
+                self.remove_user(chat_id)
+                if self.on_blocked:
+                    await self.on_blocked(chat_id)
+                return
+            except Exception as e:
+                logging.error(f"Failed to send reminder to {chat_id}: {e}")
+                return
+        logging.error(f"Gave up sending a reminder to {chat_id} after {self.max_retries} retries")
@@ -0,0 +1,144 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+
+class FSMRecord:
+    __slots__ = ('state', 'data', 'updated_at')
+
+    def __init__(self, state=None, data=None, updated_at=0):
+        self.state = state
+        self.data = data or {}
+        self.updated_at = updated_at
+
+
+# FSM storage kept in the fsm_storage table of users.db.
+#
+# Recently used records live in an in-memory LRU. Changes are written
+# behind: they are marked dirty and flushed together every
+# `flush_interval` seconds, so a conversation step costs no DB round
+# trip. Records untouched for `ttl` seconds are treated as abandoned and
+# removed from memory and from the table.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, db, key_builder=None, cache_size=10000, ttl=7 * 24 * 3600,
+                 flush_interval=0.5, purge_interval=3600):
+        self.db = db
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        self._records = OrderedDict()
+        self._dirty = set()
+        self._flusher = None
+
+    async def set_state(self, key, state=None):
+        key = self.key_builder.build(key)
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(key, record)
+
+    async def get_state(self, key):
+        return (await self._get_record(self.key_builder.build(key))).state
+
+    async def set_data(self, key, data):
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        key = self.key_builder.build(key)
+        record = await self._get_record(key)
+        record.data = data.copy()
+        self._mark_dirty(key, record)
+
+    async def get_data(self, key):
+        return (await self._get_record(self.key_builder.build(key))).data.copy()
+
+    # Conversations per state, counting only records that have not expired
+    async def count_states(self):
+        await self.flush()
+        counts = await self.db.count_fsm_states(time.time() - self.ttl)
+        counts.pop(None, None)
+        return counts
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
+    async def _get_record(self, key):
+        now = time.time()
+
+        record = self._records.get(key)
+        if record is not None:
+            self._records.move_to_end(key)
+        else:
+            row = await self.db.get_fsm_record(key)
+            record = FSMRecord(row['state'], json.loads(row['data']), row['updated_at']) if row else FSMRecord()
+            # Another coroutine may have loaded the same key meanwhile
+            record = self._records.setdefault(key, record)
+            self._evict()
+
+        if record.updated_at and now - record.updated_at > self.ttl:
+            record.state, record.data = None, {}
+        return record
+
+    def _mark_dirty(self, key, record):
+        record.updated_at = time.time()
+        self._dirty.add(key)
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    def _evict(self):
+        while len(self._records) > self.cache_size:
+            key = next(iter(self._records))
+            if key in self._dirty:
+                # Unsaved changes stay in memory until the next flush
+                break
+            del self._records[key]
+
+    async def _flush_loop(self):
+        last_purge = time.time()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.time() - last_purge > self.purge_interval:
+                    await self.purge()
+                    last_purge = time.time()
+            except Exception as e:
+                logging.error(f"FSM storage flush failed: {e}")
+
+    async def flush(self):
+        if not self._dirty:
+            return
+
+        dirty, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for key in dirty:
+            record = self._records.get(key)
+            if record is None:
+                continue
+            if record.state is None and not record.data:
+                deletes.append((key,))
+            else:
+                upserts.append((key, record.state, json.dumps(record.data), record.updated_at))
+
+        try:
+            await self.db.save_fsm_records(upserts, deletes)
+        except Exception:
+            self._dirty |= dirty
+            raise
+        self._evict()
+
+    async def purge(self):
+        expired_before = time.time() - self.ttl
+        await self.db.purge_fsm_records(expired_before)
+        for key in [key for key, record in self._records.items()
+                    if record.updated_at and record.updated_at < expired_before and key not in self._dirty]:
+            del self._records[key]
@@ -0,0 +1,108 @@
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import extract_flags_from_object
+from aiogram.types import CallbackQuery, Message
+
+
+class Bucket:
+    __slots__ = ('tokens', 'updated', 'warned_until')
+
+    def __init__(self, capacity, now):
+        self.tokens = capacity
+        self.updated = now
+        self.warned_until = 0
+
+
+# Token buckets keyed by user or chat. Only the `max_size` most recently
+# used keys are remembered; a forgotten key simply starts again with a
+# full bucket, which is what an idle one would have refilled to anyway.
+class Buckets:
+    def __init__(self, rate, capacity, max_size=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+
+    def take(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = Bucket(self.capacity, now)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens = min(self.capacity, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return None
+        return bucket
+
+
+# Throttles updates per user and per chat before they reach a handler.
+#
+# Throttled users get one polite notice per `notice_interval` and the
+# update is dropped. Handlers flagged `expensive` (aiogram's
+# `@flags.expensive`, also read from the matched menu button) run at most
+# once at a time per user and chat: taps that arrive while one is still
+# running are collapsed into it.
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, user_rate=1, user_burst=5, chat_rate=3, chat_burst=20,
+                 notice_interval=10, max_size=10000):
+        self.users = Buckets(user_rate, user_burst, max_size)
+        self.chats = Buckets(chat_rate, chat_burst, max_size)
+        self.notice_interval = notice_interval
+        self._in_flight = set()
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        chat = data.get('event_chat')
+        now = time.monotonic()
+
+        throttled = user is not None and self.users.take(user.id, now)
+        if not throttled and chat is not None and chat.type != 'private':
+            throttled = self.chats.take(chat.id, now)
+        if throttled:
+            await self._notify(event, throttled, now)
+            return None
+
+        if not self._expensive(data):
+            return await handler(event, data)
+
+        key = (user.id if user else None, chat.id if chat else None, self._name(data))
+        if key in self._in_flight:
+            logging.info(f"Collapsed a repeated {key[2]} request from {key[0]}")
+            if isinstance(event, CallbackQuery):
+                await event.answer("Still working on your previous request...")
+            return None
+
+        self._in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight.discard(key)
+
+    @staticmethod
+    def _callback(data):
+        command = data.get('text_command')
+        return (command or data['handler']).callback
+
+    def _expensive(self, data):
+        return bool(extract_flags_from_object(self._callback(data)).get('expensive'))
+
+    def _name(self, data):
+        return self._callback(data).__name__
+
+    async def _notify(self, event, bucket, now):
+        if isinstance(event, CallbackQuery):
+            # A callback has to be answered either way
+            await event.answer("Too many requests, please slow down a little.")
+            return
+        if bucket.warned_until > now or not isinstance(event, Message):
+            return
+        bucket.warned_until = now + self.notice_interval
+        await event.answer("Too many requests, please wait a few seconds and try again.")
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import signal
+from contextlib import suppress
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+
+# Webhook handler that answers Telegram right away and, on shutdown,
+# waits for the updates still being processed before closing the bot.
+class DrainingRequestHandler(SimpleRequestHandler):
+    def __init__(self, *args, drain_timeout=30, **kwargs):
+        super().__init__(*args, handle_in_background=True, **kwargs)
+        self.drain_timeout = drain_timeout
+
+    async def close(self):
+        pending = set(self._background_feed_update_tasks)
+        if pending:
+            logging.info(f"Draining {len(pending)} in-flight updates")
+            _, still_running = await asyncio.wait(pending, timeout=self.drain_timeout)
+            if still_running:
+                logging.warning(f"{len(still_running)} updates still running after drain timeout")
+        await super().close()
+
+
+# Resolves once the process gets SIGINT or SIGTERM
+async def wait_for_stop_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+
+async def run_webhook(dp, bot, base_url, path='/webhook', host='0.0.0.0', port=8080,
+                      secret_token=None, max_connections=40, drain_timeout=30):
+    app = web.Application()
+    handler = DrainingRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret_token,
+        drain_timeout=drain_timeout,
+    )
+    handler.register(app, path=path)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app, shutdown_timeout=drain_timeout)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    await bot.set_webhook(
+        base_url.rstrip('/') + path,
+        secret_token=secret_token,
+        max_connections=max_connections,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logging.info(f"Webhook server listening on {host}:{port}{path}")
+
+    try:
+        await wait_for_stop_signal()
+    finally:
+        await runner.cleanup()
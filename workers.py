@@ -0,0 +1,218 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import secrets
+import time
+from collections import deque
+
+from aiohttp import web
+from aiogram.exceptions import TelegramNetworkError, TelegramServerError
+
+from webhook import wait_for_stop_signal
+
+
+# Consistent hash ring over worker indexes. Hashing is done with md5,
+# so every process maps a chat_id to the same worker.
+class HashRing:
+    def __init__(self, nodes, replicas=100):
+        self._ring = sorted(
+            (self._hash(f"{node}:{replica}"), node)
+            for node in nodes
+            for replica in range(replicas)
+        )
+        self._hashes = [entry[0] for entry in self._ring]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+    def node_for(self, key):
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
+# Shard key of a raw update: the chat it belongs to, or the user for
+# updates without a chat (inline queries and the like).
+def routing_key(update):
+    for field, value in update.items():
+        if not isinstance(value, dict):
+            continue
+        if 'chat' in value:
+            return value['chat']['id']
+        if 'message' in value and isinstance(value['message'], dict) and 'chat' in value['message']:
+            return value['message']['chat']['id']
+        if 'from' in value:
+            return value['from']['id']
+    return update.get('update_id', 0)
+
+
+# Runs updates of the same chat one after another, different chats concurrently.
+class ChatSequencer:
+    def __init__(self, handle):
+        self.handle = handle
+        self._queues = {}
+        self._tasks = set()
+
+    def submit(self, key, update):
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(update)
+            return
+
+        queue = self._queues[key] = deque([update])
+        task = asyncio.create_task(self._drain(key, queue))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key, queue):
+        try:
+            while queue:
+                update = queue.popleft()
+                try:
+                    await self.handle(update)
+                except Exception as e:
+                    logging.error(f"Failed to handle update for {key}: {e}")
+        finally:
+            del self._queues[key]
+
+    async def wait(self):
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+# Worker side: feed updates from the supervisor's queue until it sends None.
+async def serve_updates(queue, handle):
+    loop = asyncio.get_running_loop()
+    sequencer = ChatSequencer(handle)
+    while True:
+        update = await loop.run_in_executor(None, queue.get)
+        if update is None:
+            break
+        sequencer.submit(routing_key(update), update)
+    await sequencer.wait()
+
+
+# Supervisor side: owns the update source (long polling or webhook) and
+# routes every raw update to the worker process owning its chat.
+#
+# A worker that dies is restarted with the same index and queue, so the
+# updates routed to it meanwhile are not lost. A worker crashing more than
+# `max_restarts` times within `restart_window` seconds stops the supervisor.
+class Supervisor:
+    def __init__(self, target, workers, replicas=100, max_restarts=5, restart_window=60):
+        self.context = multiprocessing.get_context('spawn')
+        self.target = target
+        self.workers = workers
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.ring = HashRing(range(workers), replicas)
+        self.queues = [self.context.Queue() for _ in range(workers)]
+        self.processes = [self._process(index) for index in range(workers)]
+
+    def _process(self, index):
+        return self.context.Process(target=self.target, args=(index, self.workers, self.queues[index]),
+                                    name=f"worker-{index}")
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        logging.info(f"Started {len(self.processes)} worker processes")
+
+    async def watch(self, interval=1):
+        restarts = {index: [] for index in range(self.workers)}
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+
+                now = time.monotonic()
+                restarts[index] = [at for at in restarts[index] if now - at < self.restart_window]
+                if len(restarts[index]) >= self.max_restarts:
+                    raise RuntimeError(f"{process.name} keeps exiting (code {process.exitcode}), already "
+                                       f"restarted {self.max_restarts} times within {self.restart_window}s")
+
+                logging.error(f"{process.name} exited with code {process.exitcode}, restarting it")
+                restarts[index].append(now)
+                self.processes[index] = self._process(index)
+                self.processes[index].start()
+
+    def route(self, update):
+        self.queues[self.ring.node_for(routing_key(update))].put(update)
+
+    async def stop(self, timeout=30):
+        for queue in self.queues:
+            queue.put(None)
+
+        def join():
+            for process in self.processes:
+                process.join(timeout)
+                if process.is_alive():
+                    logging.warning(f"{process.name} did not stop in time, terminating")
+                    process.terminate()
+
+        await asyncio.to_thread(join)
+
+    async def poll(self, bot, allowed_updates=None, polling_timeout=30):
+        offset = None
+        backoff = 1
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=polling_timeout, allowed_updates=allowed_updates)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logging.error(f"Failed to fetch updates: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+
+            backoff = 1
+            for update in updates:
+                self.route(update.model_dump(mode='json', by_alias=True, exclude_unset=True))
+                offset = update.update_id + 1
+
+    async def serve_webhook(self, bot, base_url, path='/webhook', host='0.0.0.0', port=8080,
+                            secret_token=None, max_connections=40, allowed_updates=None):
+        async def handle(request):
+            if secret_token and not secrets.compare_digest(
+                    request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), secret_token):
+                return web.Response(status=401, text='Unauthorized')
+            self.route(await request.json())
+            return web.json_response({})
+
+        app = web.Application()
+        app.router.add_post(path, handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+
+        await bot.set_webhook(
+            base_url.rstrip('/') + path,
+            secret_token=secret_token,
+            max_connections=max_connections,
+            allowed_updates=allowed_updates,
+        )
+        logging.info(f"Webhook server listening on {host}:{port}{path}")
+
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    async def run(self, source):
+        self.start()
+        front_end = asyncio.create_task(source)
+        watchdog = asyncio.create_task(self.watch())
+        stop = asyncio.create_task(wait_for_stop_signal())
+        tasks = {front_end, watchdog, stop}
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not stop and not task.cancelled() and task.exception() is not None:
+                    logging.error(f"Supervisor stopping: {task.exception()!r}", exc_info=task.exception())
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.stop()